@@ -3,7 +3,8 @@ from django.contrib.admin import ModelAdmin
 from django.contrib.auth.hashers import check_password, make_password
 from rest_framework_simplejwt import token_blacklist
 
-from accounts.models import User, TagSet, Significant, Profile
+from accounts.models import User, TagSet, Significant, Profile, TagSetIndex, RatingStatistics, \
+    PrecomputedMatch, UserBlock
 
 
 # Register your models here.
@@ -74,4 +75,31 @@ class Significant(ModelAdmin):
 @admin.register(Profile)
 class ProfileAdmin(ModelAdmin):
     base_model = Profile
-    list_display = [field.name for field in Profile._meta.fields]
\ No newline at end of file
+    list_display = [field.name for field in Profile._meta.fields]
+
+
+@admin.register(TagSetIndex)
+class TagSetIndexAdmin(ModelAdmin):
+    base_model = TagSetIndex
+    list_display = [field.name for field in TagSetIndex._meta.fields]
+    list_filter = ['field']
+
+
+@admin.register(RatingStatistics)
+class RatingStatisticsAdmin(ModelAdmin):
+    base_model = RatingStatistics
+    list_display = [field.name for field in RatingStatistics._meta.fields]
+
+
+@admin.register(PrecomputedMatch)
+class PrecomputedMatchAdmin(ModelAdmin):
+    base_model = PrecomputedMatch
+    list_display = [field.name for field in PrecomputedMatch._meta.fields]
+    list_filter = ['is_dirty']
+
+
+@admin.register(UserBlock)
+class UserBlockAdmin(ModelAdmin):
+    base_model = UserBlock
+    list_display = [field.name for field in UserBlock._meta.fields]
+    search_fields = ["blocker__email", "blocked__email"]
@@ -0,0 +1,154 @@
+import json
+import random
+import time
+import tracemalloc
+from decimal import Decimal
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from accounts.models import User, UserBlock, TagSet, TagSetIndex, RatingStatistics, COLLEGE_CHOICES, DEPARTMENT_CHOICES, \
+    GRADE_CHOICES, GENDER_CHOICES, PLACE_CHOICES, PERSON_CHOICES, METHOD_CHOICES
+from accounts.views import UserSearch
+
+
+class Rollback(Exception):
+    pass
+
+
+def to_base36(number):
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    result = ''
+    while True:
+        number, rest = divmod(number, 36)
+        result = digits[rest] + result
+        if not number:
+            return result
+
+
+def generate_campus(size, rng, batch_size=2000):
+    """
+    Creates ``size`` synthetic users spread over the real college/department choices,
+    with one to three tagsets each, ratings and block lists.
+    """
+    users = list()
+    for i in range(size):
+        college = rng.choice(COLLEGE_CHOICES)[0]
+        department = rng.choice(DEPARTMENT_CHOICES)[0]
+        users.append(User(
+            name=f'bench{i}',
+            email=f'bench{i}@bench.kookmin.ac.kr',
+            password='!',
+            nickname='~' + to_base36(i),
+            college=college,
+            department=department,
+            student_number=rng.randint(15, 24),
+            grade=rng.choice(GRADE_CHOICES)[0],
+            gender=rng.choice(GENDER_CHOICES)[0],
+            birth=rng.randint(1995, 2005),
+            rating=Decimal(rng.randint(0, 500)) / 100,
+        ))
+    users = User.objects.bulk_create(users, batch_size=batch_size)
+
+    user_ids = [user.id for user in users]
+    blocks = list()
+    for user in users:
+        for blocked_id in set(rng.sample(user_ids, rng.choice((0, 0, 0, 1, 2, 5)))) - {user.id}:
+            blocks.append(UserBlock(blocker_id=user.id, blocked_id=blocked_id))
+    UserBlock.objects.bulk_create(blocks, batch_size=batch_size)
+
+    tagsets = list()
+    for user in users:
+        for _ in range(rng.randint(1, 3)):
+            tagsets.append(TagSet(
+                owner=user,
+                place=rng.choice(PLACE_CHOICES)[0],
+                method=rng.choice(METHOD_CHOICES)[0],
+                person=rng.choice(PERSON_CHOICES)[0],
+                isSameDepartment=rng.random() < 0.5,
+                is_active=rng.random() < 0.8,
+            ))
+    tagsets = TagSet.objects.bulk_create(tagsets, batch_size=batch_size)
+
+    # bulk_create skips the receivers that keep these up to date
+    TagSetIndex.objects.rebuild(batch_size=batch_size)
+    RatingStatistics.objects.rebuild()
+    return users, [tagset for tagset in tagsets if tagset.is_active]
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the user search on synthetic campus data and prints the results as JSON. " \
+           "The data is created inside a transaction that is rolled back afterwards."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scales', type=int, nargs='+', default=[1000, 10000, 100000])
+        parser.add_argument('--backends', nargs='+', default=['array', 'database'])
+        parser.add_argument('--searches', type=int, default=50)
+        parser.add_argument('--memory-searches', type=int, default=5)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help="write the JSON results to this file instead of stdout")
+
+    def handle(self, *args, **options):
+        results = list()
+        for scale in options['scales']:
+            try:
+                with transaction.atomic():
+                    rng = random.Random(options['seed'])
+                    started = time.perf_counter()
+                    users, tagsets = generate_campus(scale, rng)
+                    self.stderr.write(f"generated {scale} users in {time.perf_counter() - started:.1f}s")
+                    searches = rng.sample(tagsets, min(options['searches'], len(tagsets)))
+                    for backend in options['backends']:
+                        with override_settings(MATCHING_BACKEND=backend):
+                            results.append(self.measure(scale, backend, searches, options['memory_searches']))
+                    raise Rollback
+            except Rollback:
+                pass
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+
+    def search(self, view, factory, tagset):
+        request = factory.get(f'/api/accounts/v2/user-search/{tagset.id}')
+        force_authenticate(request, user=tagset.owner)
+        response = view(request, id=tagset.id)
+        response.render()
+        return response
+
+    def measure(self, scale, backend, searches, memory_searches):
+        view = UserSearch.as_view()
+        factory = APIRequestFactory()
+        latencies = list()
+        queries = list()
+        for tagset in searches:
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                self.search(view, factory, tagset)
+                latencies.append((time.perf_counter() - started) * 1000)
+            queries.append(len(captured))
+
+        peak = 0
+        for tagset in searches[:memory_searches]:
+            tracemalloc.start()
+            self.search(view, factory, tagset)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+        return {
+            'scale': scale,
+            'backend': backend,
+            'searches': len(latencies),
+            'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+            'p99_ms': round(float(np.percentile(latencies, 99)), 3),
+            'mean_queries': round(float(np.mean(queries)), 2),
+            'max_queries': max(queries),
+            'peak_memory_kb': round(peak / 1024, 1),
+        }
@@ -0,0 +1,47 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from accounts.matching import candidate_pool, get_matching_engine, rank_keys
+from accounts.models import TagSet, PrecomputedMatch, SEARCH_LIMIT
+
+
+def compute_chunk(tagset_ids, limit):
+    engine = get_matching_engine()
+    for tagset in TagSet.objects.filter(id__in=tagset_ids).select_related('owner'):
+        tags = candidate_pool(tagset.owner, tagset)
+        ids = [tag.id for tag in engine.rank(tagset, tags, limit=limit)]
+        PrecomputedMatch.objects.store(tagset.id, ids, rank_keys(tagset, ids))
+    connections.close_all()
+    return len(tagset_ids)
+
+
+class Command(BaseCommand):
+    help = "Stores the ranked matches of active tagsets whose precomputed matches are missing, dirty or expired"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help="recompute every active tagset")
+        parser.add_argument('--workers', type=int, default=os.cpu_count())
+        parser.add_argument('--chunk-size', type=int, default=200)
+        parser.add_argument('--limit', type=int, default=SEARCH_LIMIT)
+
+    def handle(self, *args, **options):
+        if options['full']:
+            tagset_ids = list(TagSet.objects.filter(is_active=True).order_by('id').values_list('id', flat=True))
+        else:
+            tagset_ids = list(PrecomputedMatch.objects.stale_tagset_ids().order_by('id'))
+        chunk_size = options['chunk_size']
+        chunks = [tagset_ids[i:i + chunk_size] for i in range(0, len(tagset_ids), chunk_size)]
+        compute = partial(compute_chunk, limit=options['limit'])
+
+        if options['workers'] <= 1 or len(chunks) <= 1:
+            done = sum(map(compute, chunks))
+        else:
+            # forked workers must not share the parent's database connections
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+                done = sum(executor.map(compute, chunks))
+        self.stdout.write(self.style.SUCCESS(f"Precomputed matches for {done} tagsets"))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from accounts.models import RatingStatistics
+
+
+class Command(BaseCommand):
+    help = "Recomputes the running rating sum and user count used by the user search"
+
+    def handle(self, *args, **options):
+        RatingStatistics.objects.rebuild()
+        stats = RatingStatistics.objects.current()
+        self.stdout.write(self.style.SUCCESS(f"Rating total {stats.total} over {stats.count} users"))
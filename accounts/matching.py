@@ -0,0 +1,266 @@
+import numpy as np
+from django.conf import settings
+from django.db.models import Case, DecimalField, Exists, F, IntegerField, Max, OuterRef, Q, Value, When
+from django.db.models.functions import Cast, Coalesce, Round
+
+from accounts.models import TagSet, TagSetIndex, UserBlock
+from chat.models import Room
+
+SENIOR = "선배"
+PEER = "동기"
+JUNIOR = "후배"
+
+
+class CandidateArrays:
+    """
+    Candidate tagsets and their owners' department, student_number and rating
+    packed column-wise into NumPy arrays, loaded with a single query.
+
+    Text columns are stored as small integer codes, one vocabulary per column,
+    so comparing them is a vectorized integer compare.
+    """
+    fields = ('id', 'place', 'method', 'person', 'isSameDepartment',
+              'owner__department', 'owner__student_number', 'owner__rating')
+
+    def __init__(self, tags):
+        rows = list(tags.order_by('id').values_list(*self.fields))
+        self.size = len(rows)
+        self.vocabularies = dict()
+        self.ids = np.array([row[0] for row in rows], dtype=np.int64)
+        self.place = self.encode('place', [row[1] for row in rows])
+        self.method = self.encode('method', [row[2] for row in rows])
+        self.person = self.encode('person', [row[3] for row in rows])
+        self.is_same_department = np.array([row[4] for row in rows], dtype=bool)
+        self.department = self.encode('department', [row[5] for row in rows])
+        self.has_student_number = np.array([row[6] is not None for row in rows], dtype=bool)
+        self.student_number = np.array([row[6] or 0 for row in rows], dtype=np.int64)
+        self.rating_cents = np.array([int((row[7] or 0) * 100) for row in rows], dtype=np.int64)
+
+    def code(self, field, value):
+        vocabulary = self.vocabularies.setdefault(field, dict())
+        return vocabulary.setdefault(value, len(vocabulary))
+
+    def encode(self, field, values):
+        return np.array([self.code(field, value) for value in values], dtype=np.int32)
+
+
+class ArrayMatchingEngine:
+    """
+    Scores every candidate tagset for a user tagset with batched array operations.
+
+    The rules are the ones UserSearch has always applied: one point each for the
+    same place and method, one point when the user's person/department wish holds
+    for the candidate, one point when the candidate's wish holds for the user,
+    plus the candidate owner's rating distance from the mean.
+    """
+
+    def load(self, tags):
+        return CandidateArrays(tags)
+
+    def points(self, user_tag, candidates):
+        user = user_tag.owner
+        department = candidates.code('department', user.department)
+        student_number = user.student_number
+
+        points = (candidates.place == candidates.code('place', user_tag.place)).astype(np.int64)
+        points += candidates.method == candidates.code('method', user_tag.method)
+
+        if user_tag.isSameDepartment:
+            forward = candidates.department == department
+        else:
+            forward = candidates.department != department
+        forward &= self.person_check(user_tag.person, student_number, candidates.student_number,
+                                     candidates.has_student_number)
+        points += forward
+
+        backward = np.where(candidates.is_same_department,
+                            candidates.department == department,
+                            candidates.department != department)
+        backward &= self.reverse_person_check(candidates, student_number)
+        points += backward
+        return points
+
+    def person_check(self, person, student_number, other_student_numbers, has_student_number):
+        if person not in (SENIOR, PEER, JUNIOR):
+            return np.ones(other_student_numbers.shape, dtype=bool)
+        if student_number is None:
+            return np.zeros(other_student_numbers.shape, dtype=bool)
+        if person == SENIOR:
+            return has_student_number & (student_number > other_student_numbers)
+        if person == PEER:
+            return has_student_number & (student_number == other_student_numbers)
+        return has_student_number & (student_number < other_student_numbers)
+
+    def reverse_person_check(self, candidates, student_number):
+        person = candidates.person
+        senior, peer, junior = (candidates.code('person', value) for value in (SENIOR, PEER, JUNIOR))
+        result = ~np.isin(person, (senior, peer, junior))
+        if student_number is None:
+            return result
+        valid = candidates.has_student_number
+        result |= (person == senior) & valid & (candidates.student_number > student_number)
+        result |= (person == peer) & valid & (candidates.student_number == student_number)
+        result |= (person == junior) & valid & (candidates.student_number < student_number)
+        return result
+
+    def rank_key(self, user_tag, candidates):
+        # the old score subtracted the rating mean from every candidate alike, so ranking on
+        # exact cents gives the same order without the mean and without float ties
+        return self.points(user_tag, candidates) * 100 + candidates.rating_cents
+
+    def rank_ids(self, user_tag, candidates, limit=None):
+        if candidates.size == 0:
+            return []
+        # the stable sort keeps id order among equal scores like the old dict sort did
+        order = np.argsort(-self.rank_key(user_tag, candidates), kind='stable')
+        if limit is not None:
+            order = order[:limit]
+        return candidates.ids[order].tolist()
+
+    def rank_from_postings(self, user_tag, tags, limit=4):
+        """
+        Ranks only the tagsets found in the place/method posting lists of the user's tagset.
+
+        Everything outside those lists scores at most 2 points plus its owner's rating,
+        so the result is returned only when the last of the top ``limit`` strictly beats
+        that bound. Otherwise returns None and the caller ranks the whole pool.
+        """
+        pool = TagSetIndex.objects.postings(place=user_tag.place, method=user_tag.method)
+        candidates = self.load(tags.filter(id__in=pool))
+        if candidates.size < limit:
+            return None
+        key = self.rank_key(user_tag, candidates)
+        order = np.argsort(-key, kind='stable')[:limit]
+        best_rating = tags.exclude(id__in=pool).aggregate(best=Max('owner__rating'))['best']
+        if best_rating is not None and key[order[-1]] <= 200 + int(best_rating * 100):
+            return None
+        return candidates.ids[order].tolist()
+
+    def rank(self, user_tag, tags, limit=4):
+        ids = self.rank_from_postings(user_tag, tags, limit)
+        if ids is None:
+            candidates = self.load(tags)
+            if candidates.size < limit:
+                ids = candidates.ids.tolist()
+            else:
+                ids = self.rank_ids(user_tag, candidates, limit)
+        return fetch_in_order(ids)
+
+    def ranking(self, user_tag, tags):
+        return self.rank_ids(user_tag, self.load(tags))
+
+    def rank_many(self, user_tags, tags, limit=4):
+        """Ranks one shared candidate pool for several tagsets of the same user"""
+        candidates = self.load(tags)
+        results = dict()
+        for user_tag in user_tags:
+            if candidates.size < limit:
+                results[user_tag.id] = candidates.ids.tolist()
+            else:
+                results[user_tag.id] = self.rank_ids(user_tag, candidates, limit)
+        tags = TagSet.objects.in_bulk({i for ids in results.values() for i in ids})
+        return {tag_id: [tags[i] for i in ids if i in tags] for tag_id, ids in results.items()}
+
+
+class DatabaseMatchingEngine:
+    """
+    Expresses the UserSearch rules as Case/When annotations so the database
+    returns the top ``limit`` tagsets of the pool in one ordered query.
+    """
+
+    def person_condition(self, person, student_number, prefix=''):
+        if person not in (SENIOR, PEER, JUNIOR):
+            return Q()
+        if person == SENIOR:
+            return Q(**{prefix + 'student_number__lt': student_number})
+        if person == PEER:
+            return Q(**{prefix + 'student_number': student_number})
+        return Q(**{prefix + 'student_number__gt': student_number})
+
+    def annotate(self, user_tag, tags):
+        user = user_tag.owner
+        department = user.department
+        student_number = user.student_number
+
+        if user_tag.isSameDepartment:
+            forward = Q(owner__department=department)
+        else:
+            forward = ~Q(owner__department=department)
+        if student_number is None and user_tag.person in (SENIOR, PEER, JUNIOR):
+            forward = Q(pk__in=[])
+        else:
+            forward &= self.person_condition(user_tag.person, student_number, prefix='owner__')
+
+        backward_department = Q(isSameDepartment=True, owner__department=department) \
+            | Q(isSameDepartment=False) & ~Q(owner__department=department)
+        backward_person = ~Q(person__in=(SENIOR, PEER, JUNIOR))
+        if student_number is not None:
+            backward_person |= Q(person=SENIOR, owner__student_number__gt=student_number) \
+                | Q(person=PEER, owner__student_number=student_number) \
+                | Q(person=JUNIOR, owner__student_number__lt=student_number)
+
+        rating = Coalesce(F('owner__rating'), Value(0), output_field=DecimalField())
+        return tags.annotate(
+            points=Case(When(place=user_tag.place, then=1), default=0, output_field=IntegerField())
+            + Case(When(method=user_tag.method, then=1), default=0, output_field=IntegerField())
+            + Case(When(forward, then=1), default=0, output_field=IntegerField())
+            + Case(When(backward_department & backward_person, then=1), default=0, output_field=IntegerField()),
+        ).annotate(
+            # same exact integer key as the array engine, safe on backends that compute decimals as floats
+            rank_key=F('points') * 100 + Cast(Round(rating * 100), IntegerField()),
+        )
+
+    def rank(self, user_tag, tags, limit=4):
+        ranked = list(self.annotate(user_tag, tags).order_by('-rank_key', 'id')[:limit])
+        if len(ranked) < limit:
+            ranked.sort(key=lambda tag: tag.id)
+        return ranked
+
+    def rank_many(self, user_tags, tags, limit=4):
+        return {user_tag.id: self.rank(user_tag, tags, limit) for user_tag in user_tags}
+
+    def ranking(self, user_tag, tags):
+        return list(self.annotate(user_tag, tags).order_by('-rank_key', 'id')
+                    .values_list('id', flat=True))
+
+
+MATCHING_ENGINES = {
+    'array': ArrayMatchingEngine,
+    'database': DatabaseMatchingEngine,
+}
+
+
+def get_matching_engine():
+    return MATCHING_ENGINES[settings.MATCHING_BACKEND]()
+
+
+def rank_keys(user_tag, ids):
+    """The integer rank keys of the tagsets ``ids`` for ``user_tag``, in the order of ``ids``"""
+    engine = ArrayMatchingEngine()
+    candidates = engine.load(TagSet.objects.filter(id__in=ids))
+    keys = dict(zip(candidates.ids.tolist(), engine.rank_key(user_tag, candidates).tolist()))
+    return [keys[i] for i in ids]
+
+
+def fetch_in_order(ids):
+    tags = TagSet.objects.in_bulk(ids)
+    return [tags[i] for i in ids if i in tags]
+
+
+def candidate_pool(user, user_tag=None):
+    """
+    Active tagsets the user can be matched with.
+
+    Owners the user already has a chat room with are dropped with MATCHING_EXCLUDE_CHAT_PARTNERS,
+    and tagsets already paired with ``user_tag`` in a room with MATCHING_EXCLUDE_PAIRED_TAGSETS.
+    Both are anti-joins against the room indexes, the rooms are never loaded.
+    """
+    blocked = UserBlock.objects.filter(blocker=user.id).values('blocked_id')
+    tags = TagSet.objects.exclude(owner=user.id).exclude(is_active=False).exclude(owner__in=blocked)
+    if settings.MATCHING_EXCLUDE_CHAT_PARTNERS:
+        tags = tags.exclude(Exists(Room.objects.filter(
+            Q(relation=user.id, relation2=OuterRef('owner')) | Q(relation2=user.id, relation=OuterRef('owner')))))
+    if user_tag is not None and settings.MATCHING_EXCLUDE_PAIRED_TAGSETS:
+        tags = tags.exclude(Exists(Room.objects.filter(
+            Q(tagset=user_tag.id, tagset2=OuterRef('pk')) | Q(tagset2=user_tag.id, tagset=OuterRef('pk')))))
+    return tags
@@ -0,0 +1,46 @@
+# Generated by Django 4.2.3 on 2026-10-18 10:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_index(apps, schema_editor):
+    TagSet = apps.get_model('accounts', 'TagSet')
+    TagSetIndex = apps.get_model('accounts', 'TagSetIndex')
+    entries = list()
+    for tagset in TagSet.objects.filter(is_active=True).select_related('owner').iterator():
+        entries += [
+            TagSetIndex(field='place', value=tagset.place, tagset=tagset),
+            TagSetIndex(field='method', value=tagset.method, tagset=tagset),
+            TagSetIndex(field='person', value=tagset.person, tagset=tagset),
+            TagSetIndex(field='department', value=tagset.owner.department, tagset=tagset),
+        ]
+    TagSetIndex.objects.bulk_create(entries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TagSetIndex',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field', models.CharField(choices=[('place', '장소'), ('method', '행동'), ('person', '대상'), ('department', '학과')], max_length=12, verbose_name='항목')),
+                ('value', models.CharField(max_length=20, verbose_name='값')),
+                ('tagset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='index_entries', to='accounts.tagset', verbose_name='태그셋')),
+            ],
+            options={
+                'verbose_name': '태그셋 색인',
+                'verbose_name_plural': '태그셋 색인',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='tagsetindex',
+            constraint=models.UniqueConstraint(fields=('field', 'value', 'tagset'), name='unique_tagset_index_entry'),
+        ),
+        migrations.RunPython(build_index, migrations.RunPython.noop),
+    ]
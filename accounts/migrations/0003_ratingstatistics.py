@@ -0,0 +1,35 @@
+# Generated by Django 4.2.3 on 2026-10-18 11:02
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def build_statistics(apps, schema_editor):
+    User = apps.get_model('accounts', 'User')
+    RatingStatistics = apps.get_model('accounts', 'RatingStatistics')
+    ratings = User.objects.aggregate(total=Sum('rating'), count=Count('id'))
+    RatingStatistics.objects.update_or_create(pk=1, defaults={'total': ratings['total'] or 0,
+                                                              'count': ratings['count']})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_tagsetindex'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RatingStatistics',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total', models.DecimalField(decimal_places=2, default=0, max_digits=100, verbose_name='평점 합계')),
+                ('count', models.IntegerField(default=0, verbose_name='유저 수')),
+            ],
+            options={
+                'verbose_name': '평점 통계',
+                'verbose_name_plural': '평점 통계',
+            },
+        ),
+        migrations.RunPython(build_statistics, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.3 on 2026-10-18 12:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django_extensions.db.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0003_ratingstatistics'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PrecomputedMatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', django_extensions.db.fields.CreationDateTimeField(auto_now_add=True, verbose_name='created')),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(auto_now=True, verbose_name='modified')),
+                ('rank', models.PositiveSmallIntegerField(verbose_name='순위')),
+                ('is_dirty', models.BooleanField(default=False, verbose_name='갱신 필요 여부')),
+                ('candidate', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='precomputed_candidates', to='accounts.tagset', verbose_name='추천 태그셋')),
+                ('tagset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='precomputed_matches', to='accounts.tagset', verbose_name='태그셋')),
+            ],
+            options={
+                'verbose_name': '추천 결과',
+                'verbose_name_plural': '추천 결과',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='precomputedmatch',
+            constraint=models.UniqueConstraint(fields=('tagset', 'rank'), name='unique_precomputed_match_rank'),
+        ),
+    ]
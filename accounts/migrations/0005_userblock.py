@@ -0,0 +1,85 @@
+# Generated by Django 4.2.3 on 2026-10-18 13:40
+
+import json
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django_extensions.db.fields
+
+
+def parse_block_user(value):
+    # block_user was written both as a JSON object and as a JSON string holding a dict repr
+    try:
+        while isinstance(value, str):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                value = json.loads(value.replace("'", '"'))
+        return [int(i) for i in value.get('user', [])]
+    except (ValueError, TypeError, AttributeError):
+        return []
+
+
+def has_block_user(schema_editor, table):
+    # 0001_initial never recorded block_user, only databases the old model was synced to have the column
+    with schema_editor.connection.cursor() as cursor:
+        columns = schema_editor.connection.introspection.get_table_description(cursor, table)
+    return any(column.name == 'block_user' for column in columns)
+
+
+def copy_block_user(apps, schema_editor):
+    User = apps.get_model('accounts', 'User')
+    UserBlock = apps.get_model('accounts', 'UserBlock')
+    quote = schema_editor.quote_name
+    if not has_block_user(schema_editor, User._meta.db_table):
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('SELECT {}, {} FROM {}'.format(quote('id'), quote('block_user'), quote(User._meta.db_table)))
+        rows = cursor.fetchall()
+    user_ids = set(User.objects.values_list('id', flat=True))
+    blocks = list()
+    for user_id, block_user in rows:
+        for blocked_id in set(parse_block_user(block_user)):
+            if blocked_id != user_id and blocked_id in user_ids:
+                blocks.append(UserBlock(blocker_id=user_id, blocked_id=blocked_id))
+    UserBlock.objects.bulk_create(blocks, batch_size=1000, ignore_conflicts=True)
+
+
+def drop_block_user(apps, schema_editor):
+    # the field is not in the migration state, so RemoveField can't be used; drop the column directly
+    # instead of remaking the table from a state that may be missing other columns as well
+    table = apps.get_model('accounts', 'User')._meta.db_table
+    if has_block_user(schema_editor, table):
+        schema_editor.execute('ALTER TABLE {} DROP COLUMN {}'.format(
+            schema_editor.quote_name(table), schema_editor.quote_name('block_user')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0004_precomputedmatch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserBlock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', django_extensions.db.fields.CreationDateTimeField(auto_now_add=True, verbose_name='created')),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(auto_now=True, verbose_name='modified')),
+                ('blocked', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='blocked_by', to=settings.AUTH_USER_MODEL, verbose_name='차단된 유저')),
+                ('blocker', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='blocking', to=settings.AUTH_USER_MODEL, verbose_name='차단한 유저')),
+            ],
+            options={
+                'verbose_name': '유저차단',
+                'verbose_name_plural': '유저차단',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='userblock',
+            constraint=models.UniqueConstraint(fields=('blocker', 'blocked'), name='unique_user_block'),
+        ),
+        migrations.RunPython(copy_block_user, migrations.RunPython.noop),
+        migrations.RunPython(drop_block_user, migrations.RunPython.noop),
+    ]
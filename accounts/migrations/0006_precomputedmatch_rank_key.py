@@ -0,0 +1,18 @@
+# Generated by Django 4.2.3 on 2026-10-18 19:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0005_userblock'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='precomputedmatch',
+            name='rank_key',
+            field=models.BigIntegerField(null=True, verbose_name='순위 점수'),
+        ),
+    ]
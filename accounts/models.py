@@ -1,9 +1,18 @@
+from datetime import timedelta
+
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.base_user import AbstractBaseUser, BaseUserManager
 from django.contrib.auth.models import PermissionsMixin
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.signals import post_save, post_delete, pre_delete, pre_save
+from django.utils import timezone
+from django.dispatch import receiver
 from django_extensions.db.models import TimeStampedModel
 
+from accounts.recommendations import invalidate_pool, invalidate_user
+
 
 class CustomUserManager(BaseUserManager):
     def create_user(self, extra_fields):
@@ -172,7 +181,6 @@ class User(AbstractBaseUser, PermissionsMixin, TimeStampedModel):
                                          blank=True)
     birth = models.IntegerField(null=True)
     rating = models.DecimalField(max_digits=100, default=0, decimal_places=2, verbose_name="평점", null=True, blank=True)
-    block_user = models.JSONField(verbose_name="유저차단", default=default_json)
     is_active = models.BooleanField(verbose_name="활성화 여부", default=True)
     is_staff = models.BooleanField(verbose_name="스태프 여부", default=False)
     is_superuser = models.BooleanField(verbose_name="최고 관리자 여부", default=False)
@@ -189,6 +197,36 @@ class User(AbstractBaseUser, PermissionsMixin, TimeStampedModel):
         verbose_name = "유저 관리"
 
 
+class UserBlockManager(models.Manager):
+    def block(self, blocker, user_ids):
+        # the unique (blocker, blocked) constraint makes concurrent blocks of the same user a no-op
+        self.bulk_create([self.model(blocker=blocker, blocked_id=user_id) for user_id in user_ids],
+                         ignore_conflicts=True)
+        self.changed(blocker)
+
+    def unblock(self, blocker, user_ids):
+        deleted, _ = self.filter(blocker=blocker, blocked_id__in=user_ids).delete()
+        self.changed(blocker)
+        return deleted
+
+    def changed(self, blocker):
+        invalidate_user(blocker.id)
+        PrecomputedMatch.objects.mark_dirty(owner=blocker)
+
+
+class UserBlock(TimeStampedModel):
+    blocker = models.ForeignKey(User, on_delete=models.CASCADE, related_name="blocking", verbose_name="차단한 유저")
+    blocked = models.ForeignKey(User, on_delete=models.CASCADE, related_name="blocked_by", verbose_name="차단된 유저")
+    objects = UserBlockManager()
+
+    class Meta:
+        verbose_name_plural = "유저차단"
+        verbose_name = "유저차단"
+        constraints = [
+            models.UniqueConstraint(fields=['blocker', 'blocked'], name='unique_user_block'),
+        ]
+
+
 PLACE_CHOICES = (
     ('북악관', '북악관'),
     ('예술관', '예술관'),
@@ -238,3 +276,275 @@ class TagSet(TimeStampedModel):
     class Meta:
         verbose_name_plural = "태그셋 관리"
         verbose_name = "태그셋 관리"
+
+
+INDEX_FIELD_CHOICES = (
+    ('place', '장소'),
+    ('method', '행동'),
+    ('person', '대상'),
+    ('department', '학과'),
+)
+
+
+class RatingStatisticsManager(models.Manager):
+    def current(self):
+        stats, _ = self.get_or_create(pk=1)
+        return stats
+
+    def add(self, total=0, count=0):
+        if not self.filter(pk=1).update(total=F('total') + total, count=F('count') + count):
+            self.current()
+            self.filter(pk=1).update(total=F('total') + total, count=F('count') + count)
+
+    def rebuild(self):
+        ratings = User.objects.aggregate(total=Sum('rating'), count=Count('id'))
+        self.update_or_create(pk=1, defaults={'total': ratings['total'] or 0, 'count': ratings['count']})
+
+    def mean(self, exclude):
+        """
+        Mean rating of every user except the ``exclude`` queryset, whose
+        contribution is subtracted from the running totals.
+        """
+        stats = self.current()
+        excluded = exclude.aggregate(total=Sum('rating'), count=Count('id'))
+        count = stats.count - excluded['count']
+        if count <= 0:
+            return 0
+        return (stats.total - (excluded['total'] or 0)) / count
+
+
+class RatingStatistics(models.Model):
+    total = models.DecimalField(max_digits=100, default=0, decimal_places=2, verbose_name="평점 합계")
+    count = models.IntegerField(default=0, verbose_name="유저 수")
+    objects = RatingStatisticsManager()
+
+    class Meta:
+        verbose_name_plural = "평점 통계"
+        verbose_name = "평점 통계"
+
+
+@receiver(post_save, sender=User)
+def add_user_rating(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        RatingStatistics.objects.add(instance.rating or 0, 1)
+
+
+@receiver(post_delete, sender=User)
+def remove_user_rating(sender, instance, **kwargs):
+    RatingStatistics.objects.add(-(instance.rating or 0), -1)
+
+
+class TagSetIndexManager(models.Manager):
+    def entries(self, tagset):
+        return [
+            self.model(field='place', value=tagset.place, tagset=tagset),
+            self.model(field='method', value=tagset.method, tagset=tagset),
+            self.model(field='person', value=tagset.person, tagset=tagset),
+            self.model(field='department', value=tagset.owner.department, tagset=tagset),
+        ]
+
+    def index(self, tagset):
+        with transaction.atomic():
+            self.filter(tagset=tagset).delete()
+            if tagset.is_active:
+                self.bulk_create(self.entries(tagset))
+
+    def update_department(self, user):
+        self.filter(field='department', tagset__owner=user).exclude(value=user.department) \
+            .update(value=user.department)
+
+    def rebuild(self, batch_size=1000):
+        self.all().delete()
+        tagsets = TagSet.objects.filter(is_active=True).select_related('owner').order_by('id')
+        entries = list()
+        count = 0
+        for tagset in tagsets.iterator(chunk_size=batch_size):
+            entries += self.entries(tagset)
+            count += 1
+            if len(entries) >= batch_size:
+                self.bulk_create(entries)
+                entries = list()
+        self.bulk_create(entries)
+        return count
+
+    def postings(self, **values):
+        query = models.Q()
+        for field, value in values.items():
+            query |= models.Q(field=field, value=value)
+        return self.filter(query).values('tagset_id')
+
+
+class TagSetIndex(models.Model):
+    field = models.CharField(max_length=12, verbose_name="항목", choices=INDEX_FIELD_CHOICES)
+    value = models.CharField(max_length=20, verbose_name="값")
+    tagset = models.ForeignKey(TagSet, on_delete=models.CASCADE, related_name="index_entries", verbose_name="태그셋")
+    objects = TagSetIndexManager()
+
+    class Meta:
+        verbose_name_plural = "태그셋 색인"
+        verbose_name = "태그셋 색인"
+        constraints = [
+            models.UniqueConstraint(fields=['field', 'value', 'tagset'], name='unique_tagset_index_entry'),
+        ]
+
+
+# index rows of deleted tagsets and users go away with the ForeignKey cascade
+@receiver(post_save, sender=TagSet)
+def index_tagset(sender, instance, raw=False, **kwargs):
+    if not raw:
+        TagSetIndex.objects.index(instance)
+
+
+@receiver(post_save, sender=User)
+def index_user_department(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    if raw or created or (update_fields is not None and 'department' not in update_fields):
+        return
+    TagSetIndex.objects.update_department(instance)
+
+
+# results UserSearch serves, and precompute_matches stores by default
+SEARCH_LIMIT = 4
+
+
+class PrecomputedMatchManager(models.Manager):
+    def fresh(self, tagset):
+        """
+        Stored top matches of the tagset, or None when they are missing,
+        marked dirty or older than PRECOMPUTED_MATCH_TTL seconds.
+        """
+        matches = list(self.filter(tagset=tagset).select_related('candidate').order_by('rank'))
+        if not matches:
+            return None
+        expires = timezone.now() - timedelta(seconds=settings.PRECOMPUTED_MATCH_TTL)
+        if any(match.is_dirty or match.created < expires for match in matches):
+            return None
+        return [match.candidate for match in matches]
+
+    def store(self, tagset_id, candidate_ids, rank_keys):
+        with transaction.atomic():
+            self.filter(tagset_id=tagset_id).delete()
+            self.bulk_create([self.model(tagset_id=tagset_id, candidate_id=candidate_id, rank=rank, rank_key=rank_key)
+                              for rank, (candidate_id, rank_key) in enumerate(zip(candidate_ids, rank_keys))])
+
+    def mark_dirty(self, **tagset_filter):
+        """Marks the stored matches of the filtered tagsets, and of every tagset they were recommended to"""
+        tagsets = TagSet.objects.filter(**tagset_filter).values('id')
+        sources = self.filter(models.Q(tagset__in=tagsets) | models.Q(candidate__in=tagsets)).values('tagset_id')
+        return self.filter(tagset__in=sources, is_dirty=False).update(is_dirty=True)
+
+    def mark_entered(self, tagset):
+        """
+        Marks the stored matches ``tagset`` could now enter, after it was created, activated or
+        its owner's rating went up. It scores at most 2 points on department and person, plus
+        one each for the same place and method, plus its owner's rating, so only lists whose
+        lowest rank_key is below that bound, or that hold fewer than SEARCH_LIMIT entries, move.
+        """
+        if not tagset.is_active:
+            return 0
+        cents = int((tagset.owner.rating or 0) * 100)
+        lists = self.exclude(tagset__owner=tagset.owner_id) \
+            .values('tagset_id', 'tagset__place', 'tagset__method') \
+            .annotate(floor=models.Min('rank_key'), size=Count('id'), unscored=Count('id', filter=models.Q(rank_key=None)))
+        entered = models.Q(size__lt=SEARCH_LIMIT) | models.Q(unscored__gt=0)
+        for same_place in (True, False):
+            for same_method in (True, False):
+                bound = (2 + same_place + same_method) * 100 + cents
+                place = models.Q(tagset__place=tagset.place)
+                method = models.Q(tagset__method=tagset.method)
+                entered |= (place if same_place else ~place) & (method if same_method else ~method) \
+                    & models.Q(floor__lt=bound)
+        sources = lists.filter(entered).values('tagset_id')
+        return self.filter(tagset__in=sources, is_dirty=False).update(is_dirty=True)
+
+    def stale_tagset_ids(self):
+        expires = timezone.now() - timedelta(seconds=settings.PRECOMPUTED_MATCH_TTL)
+        outdated = self.filter(models.Q(is_dirty=True) | models.Q(created__lt=expires)).values('tagset_id')
+        return TagSet.objects.filter(is_active=True) \
+            .filter(models.Q(id__in=outdated) | ~models.Q(id__in=self.values('tagset_id'))) \
+            .values_list('id', flat=True)
+
+
+class PrecomputedMatch(TimeStampedModel):
+    tagset = models.ForeignKey(TagSet, on_delete=models.CASCADE, related_name="precomputed_matches",
+                               verbose_name="태그셋")
+    candidate = models.ForeignKey(TagSet, on_delete=models.CASCADE, related_name="precomputed_candidates",
+                                  verbose_name="추천 태그셋")
+    rank = models.PositiveSmallIntegerField(verbose_name="순위")
+    # points * 100 + rating cents of the candidate, see ArrayMatchingEngine.rank_key
+    rank_key = models.BigIntegerField(null=True, verbose_name="순위 점수")
+    is_dirty = models.BooleanField(default=False, verbose_name="갱신 필요 여부")
+    objects = PrecomputedMatchManager()
+
+    class Meta:
+        verbose_name_plural = "추천 결과"
+        verbose_name = "추천 결과"
+        constraints = [
+            models.UniqueConstraint(fields=['tagset', 'rank'], name='unique_precomputed_match_rank'),
+        ]
+
+
+# fields that can move a tagset in other users' rankings
+RANKING_FIELDS = {
+    TagSet: ('place', 'method', 'person', 'isSameDepartment', 'is_active', 'owner'),
+    User: ('department', 'student_number', 'rating', 'is_active'),
+}
+
+
+def ranking_changes(instance):
+    """The ranking fields the last save of ``instance`` changed, noted by note_ranking_changes"""
+    return getattr(instance, '_ranking_changes', set())
+
+
+@receiver(pre_save, sender=TagSet)
+@receiver(pre_save, sender=User)
+def note_ranking_changes(sender, instance, raw=False, update_fields=None, **kwargs):
+    fields = [field for field in RANKING_FIELDS[sender] if update_fields is None or field in update_fields]
+    if raw or not fields:
+        instance._ranking_changes = set()
+        return
+    saved = None if instance._state.adding else sender.objects.filter(pk=instance.pk).values(*fields).first()
+    if saved is None:
+        instance._ranking_changes = set(fields)
+        return
+    instance._ranking_changes = {field for field in fields
+                                 if saved[field] != getattr(instance, sender._meta.get_field(field).attname)}
+
+
+@receiver(post_save, sender=TagSet)
+def mark_tagset_matches_dirty(sender, instance, created, raw=False, **kwargs):
+    if raw or not ranking_changes(instance):
+        return
+    if not created:
+        PrecomputedMatch.objects.mark_dirty(id=instance.id)
+    PrecomputedMatch.objects.mark_entered(instance)
+
+
+@receiver(pre_delete, sender=TagSet)
+def mark_deleted_tagset_matches_dirty(sender, instance, **kwargs):
+    PrecomputedMatch.objects.mark_dirty(id=instance.id)
+
+
+@receiver(post_save, sender=TagSet)
+def invalidate_tagset_recommendations(sender, instance, raw=False, **kwargs):
+    if not raw and ranking_changes(instance):
+        invalidate_pool()
+
+
+@receiver(post_delete, sender=TagSet)
+def invalidate_deleted_tagset_recommendations(sender, instance, **kwargs):
+    invalidate_pool()
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_recommendations(sender, instance, created, raw=False, **kwargs):
+    # a new user has no tagsets yet, nobody's ranking moves
+    if not raw and not created and ranking_changes(instance):
+        invalidate_pool()
+        PrecomputedMatch.objects.mark_dirty(owner=instance)
+        for tagset in instance.tagset_user.filter(is_active=True):
+            PrecomputedMatch.objects.mark_entered(tagset)
+
+
+@receiver(post_delete, sender=User)
+def invalidate_deleted_user_recommendations(sender, instance, **kwargs):
+    invalidate_pool()
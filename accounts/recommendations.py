@@ -0,0 +1,80 @@
+from uuid import uuid4
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.db import transaction
+
+POOL_VERSION_KEY = 'recommendation:pool'
+CURSOR_SALT = 'accounts.recommendations'
+
+
+def get_ttl():
+    return settings.RECOMMENDATION_SESSION_TTL
+
+
+def get_version(key, default=None):
+    """
+    The current version under ``key``. A missing key (evicted, or a fresh cache) is started
+    from ``default``, the version a cursor still names, so its session is rebuilt rather than
+    refused. Invalidation always sets a new version, which a cursor can never restore.
+    """
+    version = cache.get(key)
+    if version is None:
+        version = default or uuid4().hex
+        if not cache.add(key, version, None):
+            version = cache.get(key) or version
+    return version
+
+
+def user_version_key(user_id):
+    return f'recommendation:user:{user_id}'
+
+
+def invalidate_pool():
+    """Drops every session, after a change that can move any user's ranking"""
+    # once committed, so a concurrent search cannot cache a ranking of the old rows under the new version
+    transaction.on_commit(lambda: cache.set(POOL_VERSION_KEY, uuid4().hex, None))
+
+
+def invalidate_user(user_id):
+    """Drops the sessions of one user, e.g. after their tagsets or block list changed"""
+    transaction.on_commit(lambda: cache.set(user_version_key(user_id), uuid4().hex, None))
+
+
+def session_version(user_id, cursor_version=None):
+    """The pool and user versions a session and its cursors belong to"""
+    pool, user = cursor_version.split(':') if cursor_version else (None, None)
+    return '{}:{}'.format(get_version(POOL_VERSION_KEY, pool), get_version(user_version_key(user_id), user))
+
+
+def session_key(user_id, tagset_id, version):
+    return 'recommendation:session:{}:{}:{}'.format(user_id, tagset_id, version)
+
+
+def get_ranking(user_id, tagset_id, build, version):
+    """
+    Returns the full ranked tagset id list of a (user, tagset) session,
+    calling ``build`` only when no live session is cached.
+    """
+    key = session_key(user_id, tagset_id, version)
+    ranking = cache.get(key)
+    if ranking is None:
+        ranking = build()
+        cache.set(key, ranking, get_ttl())
+    return ranking
+
+
+def encode_cursor(tagset_id, version, offset):
+    return signing.dumps({'tagset': tagset_id, 'version': version, 'offset': offset}, salt=CURSOR_SALT, compress=True)
+
+
+def decode_cursor(cursor, tagset_id):
+    """The ``(version, offset)`` of a cursor, or None when it is not valid for the tagset"""
+    try:
+        data = signing.loads(cursor, salt=CURSOR_SALT)
+    except signing.BadSignature:
+        return None
+    if data.get('tagset') != tagset_id or not isinstance(data.get('version'), str):
+        return None
+    return data['version'], data.get('offset')
@@ -13,7 +13,7 @@ from accounts.models import User
 from accounts.models import TagSet
 from accounts.models import Significant
 from accounts.models import Profile
-import json
+from accounts.models import UserBlock
 
 
 COLLEGE_CHOICES = (
@@ -221,13 +221,50 @@ class UserRegisterSerializer(serializers.Serializer):
         return user
 
 
+class BlockUserField(serializers.Field):
+    """
+    Blocked user ids of a user as a plain list.
+
+    Uses the prefetched ``blocking`` relation when the queryset has one, and
+    otherwise loads each user's list once per request, so a user nested many
+    times in one response (rooms, messages) costs at most one query.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs['source'] = '*'
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def get_cache(self):
+        holder = self.context.get('request') or self.root
+        if not hasattr(holder, '_block_user_cache'):
+            holder._block_user_cache = dict()
+        return holder._block_user_cache
+
+    def to_representation(self, user):
+        if 'blocking' in getattr(user, '_prefetched_objects_cache', {}):
+            return [block.blocked_id for block in user.blocking.all()]
+        cache = self.get_cache()
+        if user.pk not in cache:
+            cache[user.pk] = list(user.blocking.values_list('blocked_id', flat=True))
+        return cache[user.pk]
+
+
+# relations UserDetailSerializer/UserSerializer render, for prefetching nested users
+USER_PREFETCH = ('significant', 'groups', 'user_permissions', 'blocking')
+
+
 class UserDetailSerializer(serializers.ModelSerializer):
+    block_user = BlockUserField()
+
     class Meta:
         model = get_user_model()
         exclude = ['password', 'is_staff', 'is_superuser']
 
 
 class UserSerializer(serializers.ModelSerializer):
+    block_user = BlockUserField()
+
     class Meta:
         model = get_user_model()
         exclude = ['is_staff', 'is_superuser']
@@ -318,22 +355,32 @@ class BlockUserSerializer(serializers.Serializer):
     def validate(self, data):
         user = data.get('user')
         block_user_id = int(data.get('block_user'))
-        users = User.objects.all()
-        try:
-            block_user = json.loads(user.block_user.replace("\'", "\""))
-        except:
-            block_user = {"user":[]}
-
-        try:
-            get_user = User.objects.get(id=block_user_id)
-        except:
-            get_user = -1
-            
-        if block_user_id in block_user['user']:
+
+        if UserBlock.objects.filter(blocker=user, blocked_id=block_user_id).exists():
             raise serializers.ValidationError("이미 차단한 유저입니다.")
 
-        if get_user not in users:
+        if not User.objects.filter(id=block_user_id).exists():
             raise serializers.ValidationError("존재하지 않는 유저입니다.")
-        
-        if get_user == user:
-            raise serializers.ValidationError("자신을 차단할 수 없습니다.")
\ No newline at end of file
+
+        if block_user_id == user.id:
+            raise serializers.ValidationError("자신을 차단할 수 없습니다.")
+        return data
+
+
+class BlockUserBulkSerializer(serializers.Serializer):
+    action = serializers.ChoiceField(choices=(('block', 'block'), ('unblock', 'unblock')))
+    users = serializers.ListField(child=serializers.IntegerField(), allow_empty=False, max_length=500)
+
+    def validate(self, data):
+        user = self.context['request'].user
+        user_ids = set(data['users'])
+
+        if user.id in user_ids:
+            raise serializers.ValidationError("자신을 차단할 수 없습니다.")
+
+        if data['action'] == 'block':
+            found = set(User.objects.filter(id__in=user_ids).values_list('id', flat=True))
+            if found != user_ids:
+                raise serializers.ValidationError("존재하지 않는 유저입니다.")
+        data['users'] = sorted(user_ids)
+        return data
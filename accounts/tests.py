@@ -1,3 +1,500 @@
-from django.test import TestCase
+import io
+import json
+import random
+from decimal import Decimal
+from importlib import import_module
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from allauth.account.models import EmailAddress
+from django.apps import apps
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from rest_framework.test import APIClient
+
+from accounts.matching import ArrayMatchingEngine, CandidateArrays, DatabaseMatchingEngine, candidate_pool
+from accounts.models import User, TagSet, UserBlock, RatingStatistics, PrecomputedMatch
+from chat.models import Room
+
+PLACES = ('북악관', '미래관', '도서관')
+METHODS = ('공부', '식사', '수다')
+PERSONS = ('선배', '동기', '후배')
+DEPARTMENTS = ('소프트웨어학부', '경영학부')
+
+userblock_migration = import_module('accounts.migrations.0005_userblock')
+
+
+def baseline_search(user, user_tag):
+    """The top 4 ids of the UserSearch algorithm the engines replaced, one tagset at a time"""
+    tags = list(TagSet.objects.exclude(owner=user.id).exclude(is_active=False).select_related('owner').order_by('id'))
+    users = User.objects.exclude(id=user.id)
+    rating_mean = sum(u.rating for u in users) / len(users)
+    scores = {tag.id: 0 for tag in tags}
+    for tag in tags:
+        scores[tag.id] += (tag.place == user_tag.place) + (tag.method == user_tag.method)
+
+    def check(tag, other_tag, scored_tag):
+        owner, other = tag.owner, other_tag.owner
+        if tag.isSameDepartment != (owner.department == other.department):
+            return
+        if tag.person == '선배':
+            matched = owner.student_number > other.student_number
+        elif tag.person == '동기':
+            matched = owner.student_number == other.student_number
+        elif tag.person == '후배':
+            matched = owner.student_number < other.student_number
+        else:
+            matched = True
+        if matched:
+            scores[scored_tag.id] += 1
+
+    for tag in tags:
+        check(user_tag, tag, tag)
+        check(tag, user_tag, tag)
+        scores[tag.id] += tag.owner.rating - rating_mean
+    return [tag_id for tag_id, _ in sorted(scores.items(), key=lambda x: x[1], reverse=True)][:4]
+
+
+class MatchingParityTest(TestCase):
+    def create_users(self, count, rating):
+        self.random = random.Random(count)
+        for index in range(count):
+            user = User.objects.create(email=f'user{index}@kookmin.ac.kr', nickname=f'user{index}', name='user',
+                                       department=self.random.choice(DEPARTMENTS),
+                                       student_number=self.random.choice((20, 21, 22)), gender='남',
+                                       rating=rating())
+            for _ in range(self.random.randint(1, 2)):
+                TagSet.objects.create(owner=user, place=self.random.choice(PLACES),
+                                      method=self.random.choice(METHODS), person=self.random.choice(PERSONS),
+                                      isSameDepartment=self.random.random() < 0.5)
+
+    def assert_parity(self):
+        shortcuts = 0
+        for user_tag in TagSet.objects.select_related('owner').order_by('id'):
+            user = user_tag.owner
+            expected = baseline_search(user, user_tag)
+            tags = candidate_pool(user, user_tag)
+            for engine in (ArrayMatchingEngine(), DatabaseMatchingEngine()):
+                self.assertEqual([tag.id for tag in engine.rank(user_tag, tags)], expected,
+                                 f'{type(engine).__name__} for tagset {user_tag.id}')
+            ids = ArrayMatchingEngine().rank_from_postings(user_tag, tags)
+            if ids is not None:
+                shortcuts += 1
+                self.assertEqual(ids, expected, f'posting lists for tagset {user_tag.id}')
+        return shortcuts
+
+    def test_engines_match_baseline_with_spread_ratings(self):
+        self.create_users(30, lambda: Decimal(self.random.randint(0, 500)) / 100)
+        self.assert_parity()
+
+    def test_posting_lists_match_baseline_with_equal_ratings(self):
+        # equal ratings keep everything outside the posting lists below the top 4 often enough
+        self.create_users(30, lambda: Decimal('3.50'))
+        self.assertGreater(self.assert_parity(), 0)
+
+    def test_candidate_columns_are_integer_codes(self):
+        self.create_users(6, lambda: Decimal('1.00'))
+        candidates = CandidateArrays(TagSet.objects.all())
+        for column in (candidates.place, candidates.method, candidates.person, candidates.department):
+            self.assertEqual(column.dtype, np.int32)
+        self.assertEqual(candidates.code('place', '없는 장소'), len(set(candidates.place.tolist())))
+
+    @override_settings(MATCHING_BACKEND='database')
+    def test_user_search_view(self):
+        self.create_users(12, lambda: Decimal(self.random.randint(0, 500)) / 100)
+        user_tag = TagSet.objects.select_related('owner').first()
+        client = APIClient()
+        client.force_authenticate(user_tag.owner)
+        response = client.get(f'/api/accounts/v2/user-search/{user_tag.id}')
+        self.assertEqual([tag['id'] for tag in response.data], baseline_search(user_tag.owner, user_tag))
+
+
+class UserSearchPageTest(TestCase):
+    def setUp(self):
+        for index in range(10):
+            user = User.objects.create(email=f'user{index}@kookmin.ac.kr', nickname=f'user{index}', name='user',
+                                       department='소프트웨어학부', student_number=20, gender='남',
+                                       rating=Decimal(index))
+            TagSet.objects.create(owner=user, place='북악관', method='공부', person='동기')
+        self.user_tag = TagSet.objects.select_related('owner').first()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user_tag.owner)
+        self.url = f'/api/accounts/v2/user-search/{self.user_tag.id}/page'
+
+    def test_pages_follow_one_ranking(self):
+        ids = list()
+        response = self.client.get(self.url)
+        while True:
+            ids += [tag['id'] for tag in response.data['results']]
+            if response.data['next'] is None:
+                break
+            response = self.client.get(self.url, {'cursor': response.data['next']})
+        self.assertEqual(ids, list(TagSet.objects.exclude(id=self.user_tag.id).order_by('-owner__rating')
+                                   .values_list('id', flat=True)))
+
+    def test_cursor_expires_with_the_session(self):
+        cursor = self.client.get(self.url).data['next']
+        self.assertEqual(self.client.get(self.url, {'cursor': cursor}).status_code, 200)
+
+        # saves that leave the ranking fields alone keep every session
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            user = User.objects.get(rating=9)
+            user.name = 'renamed'
+            user.save()
+            self.user_tag.introduction = 'hello'
+            self.user_tag.save()
+        self.assertEqual(callbacks, [])
+        self.assertEqual(self.client.get(self.url, {'cursor': cursor}).status_code, 200)
+
+        # the version moves once the change is committed
+        with self.captureOnCommitCallbacks(execute=True):
+            user.rating = 0
+            user.save()
+            self.assertEqual(self.client.get(self.url, {'cursor': cursor}).status_code, 200)
+        self.assertEqual(self.client.get(self.url, {'cursor': cursor}).status_code, 400)
+        response = self.client.get(self.url)
+        self.assertEqual(len(response.data['results']), 4)
+        self.assertEqual(self.client.get(self.url, {'cursor': response.data['next']}).status_code, 200)
+
+    def test_lost_versions_rebuild_the_session(self):
+        first = self.client.get(self.url).data
+        cache.clear()
+        response = self.client.get(self.url, {'cursor': first['next']})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'][0]['id'], TagSet.objects.get(owner__rating=5).id)
+        self.assertEqual(self.client.get(self.url, {'cursor': response.data['next']}).status_code, 200)
+
+
+class UserSearchBatchTest(TestCase):
+    url = '/api/accounts/v2/user-search/batch'
+
+    def setUp(self):
+        places, methods = ['북악관', '미래관', '법학관'], ['공부', '식사']
+        users = [User.objects.create(email=f'user{index}@kookmin.ac.kr', nickname=f'user{index}', name='user',
+                                     department='소프트웨어학부', student_number=20 + index % 2, gender='남',
+                                     rating=Decimal(index))
+                 for index in range(10)]
+        for index, user in enumerate(users[1:], start=1):
+            TagSet.objects.create(owner=user, place=places[index % 3], method=methods[index % 2], person='동기')
+        self.user = users[0]
+        self.tagsets = [TagSet.objects.create(owner=self.user, place='북악관', method='공부', person='동기'),
+                        TagSet.objects.create(owner=self.user, place='미래관', method='식사', person='동기')]
+        TagSet.objects.create(owner=self.user, place='법학관', method='공부', person='동기', is_active=False)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def assert_matches_user_search(self, ids):
+        response = self.client.get(self.url, {'ids': ids})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(all(len(results) == 4 for results in response.data.values()))
+        self.assertEqual(response.data, {
+            str(tagset.id): self.client.get(f'/api/accounts/v2/user-search/{tagset.id}').data
+            for tagset in self.tagsets
+        })
+
+    def test_matches_user_search(self):
+        ids = ','.join(str(tagset.id) for tagset in self.tagsets)
+        self.assert_matches_user_search(ids)
+        self.assert_matches_user_search('all')
+        with override_settings(MATCHING_EXCLUDE_PAIRED_TAGSETS=True):
+            self.assert_matches_user_search('all')
+        call_command('precompute_matches', '--workers', '1', stdout=io.StringIO())
+        self.assertIsNotNone(PrecomputedMatch.objects.fresh(self.tagsets[0]))
+        self.assert_matches_user_search(ids)
+
+    def test_error_paths(self):
+        for ids in ['x', f'{self.tagsets[0].id},x', '1.5']:
+            response = self.client.get(self.url, {'ids': ids})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.data, {'message': 'Invalid ids'})
+
+        # tagsets of other users are left out, not ranked for the caller
+        others = TagSet.objects.exclude(owner=self.user).values_list('id', flat=True)[:2]
+        response = self.client.get(self.url, {'ids': ','.join(str(tag_id) for tag_id in others)})
+        self.assertEqual(response.data, {})
+        response = self.client.get(self.url, {'ids': f'{others[0]},{self.tagsets[0].id}'})
+        self.assertEqual(list(response.data), [str(self.tagsets[0].id)])
+
+
+class CandidatePoolTest(TestCase):
+    def setUp(self):
+        users = [User.objects.create(email=f'user{index}@kookmin.ac.kr', nickname=f'user{index}', name='user',
+                                     department='소프트웨어학부', student_number=20, gender='남',
+                                     rating=Decimal(9 - index))
+                 for index in range(10)]
+        # the excluded owners are the best rated, so they would lead every ranking
+        tagsets = [TagSet.objects.create(owner=user, place='북악관', method='공부', person='동기') for user in users]
+        self.user, self.user_tag = users[-1], tagsets[-1]
+        self.blocked, self.partner, self.paired = tagsets[:3]
+        self.unpaired = TagSet.objects.create(owner=users[2], place='북악관', method='공부', person='동기')
+        UserBlock.objects.block(self.user, [self.blocked.owner_id])
+        Room.objects.create(relation=self.user, relation2=self.partner.owner,
+                            tagset=self.partner, tagset2=self.user_tag)
+        Room.objects.create(relation=self.paired.owner, relation2=self.user,
+                            tagset=self.user_tag, tagset2=self.paired)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def search(self):
+        """Ids from UserSearch and from every page of the page endpoint"""
+        cache.clear()
+        url = f'/api/accounts/v2/user-search/{self.user_tag.id}'
+        top = [tag['id'] for tag in self.client.get(url).data]
+        pages = list()
+        response = self.client.get(f'{url}/page')
+        while True:
+            pages += [tag['id'] for tag in response.data['results']]
+            if response.data['next'] is None:
+                break
+            response = self.client.get(f'{url}/page', {'cursor': response.data['next']})
+        self.assertEqual(len(top), 4)
+        self.assertEqual(pages[:4], top)
+        return set(top), set(pages)
+
+    def test_blocked_users_and_chat_partners_are_left_out(self):
+        for ids in self.search():
+            self.assertIsDisjoint(ids, {self.blocked.id, self.partner.id, self.paired.id, self.unpaired.id})
+        self.assertEqual(len(self.search()[1]), 6)
+
+    @override_settings(MATCHING_EXCLUDE_CHAT_PARTNERS=False, MATCHING_EXCLUDE_PAIRED_TAGSETS=True)
+    def test_paired_tagsets_are_left_out(self):
+        top, pages = self.search()
+        for ids in (top, pages):
+            self.assertIsDisjoint(ids, {self.blocked.id, self.partner.id, self.paired.id})
+        # only the tagset the room was made for, the owner's other tagsets stay
+        self.assertIn(self.unpaired.id, top)
+        self.assertEqual(len(pages), 7)
+
+    def assertIsDisjoint(self, ids, excluded):
+        self.assertEqual(ids & excluded, set())
+
+
+class ParseBlockUserTest(SimpleTestCase):
+    def test_legacy_formats(self):
+        parse = userblock_migration.parse_block_user
+        self.assertEqual(parse('{"user": [2, 3]}'), [2, 3])
+        self.assertEqual(parse(json.dumps(json.dumps({'user': [2]}))), [2])
+        self.assertEqual(parse(json.dumps(str({'user': [4, '5']}))), [4, 5])
+        self.assertEqual(parse(str({'user': [6]})), [6])
+        self.assertEqual(parse({'user': [7]}), [7])
+        for value in (None, '', 'null', '{"user": null}', '[1, 2]', 'garbage', '{"user": ["x"]}'):
+            self.assertEqual(parse(value), [], value)
+
+
+class BlockUserTest(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create(email=f'user{index}@kookmin.ac.kr', nickname=f'user{index}', name='user',
+                                          department='소프트웨어학부', student_number=20, gender='남')
+                      for index in range(4)]
+        self.user = self.users[0]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_copy_block_user(self):
+        table = connection.ops.quote_name(User._meta.db_table)
+        with connection.cursor() as cursor:
+            # the column 0005 removes, rolled back with the test
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN block_user text')
+            values = [
+                json.dumps({'user': [self.users[1].id, self.users[2].id, self.users[1].id]}),
+                json.dumps(str({'user': [self.users[0].id, self.users[1].id, 999]})),
+                json.dumps(json.dumps({'user': [self.users[2].id]})),
+                'garbage',
+            ]
+            for user, value in zip(self.users, values):
+                cursor.execute(f'UPDATE {table} SET block_user = %s WHERE id = %s', [value, user.id])
+        userblock_migration.copy_block_user(apps, connection.schema_editor())
+
+        blocks = set(UserBlock.objects.values_list('blocker_id', 'blocked_id'))
+        # duplicates, unknown ids and self blocks are dropped
+        self.assertEqual(blocks, {(self.users[0].id, self.users[1].id), (self.users[0].id, self.users[2].id),
+                                  (self.users[1].id, self.users[0].id)})
+
+        userblock_migration.drop_block_user(apps, connection.schema_editor())
+        with connection.cursor() as cursor:
+            columns = connection.introspection.get_table_description(cursor, User._meta.db_table)
+        self.assertNotIn('block_user', [column.name for column in columns])
+        # fresh databases never had the column, both steps skip it
+        userblock_migration.copy_block_user(apps, connection.schema_editor())
+        userblock_migration.drop_block_user(apps, connection.schema_editor())
+        self.assertEqual(UserBlock.objects.count(), 3)
+
+    def test_block_user_response_shape(self):
+        UserBlock.objects.block(self.user, [self.users[2].id, self.users[1].id])
+        expected = [self.users[1].id, self.users[2].id]
+
+        response = self.client.get(f'/api/accounts/v2/user/detail/{self.user.id}/')
+        self.assertEqual(sorted(response.data['block_user']), expected)
+        response = self.client.get(f'/api/accounts/v2/user/{self.users[1].id}/')
+        self.assertEqual(response.data['block_user'], [])
+
+        self.user.set_password('password1234!')
+        self.user.save()
+        EmailAddress.objects.create(user=self.user, email=self.user.email, verified=True, primary=True)
+        response = APIClient().post('/api/accounts/login/', {'email': self.user.email, 'password': 'password1234!'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(response.data['user']['block_user']), expected)
+
+
+class BlockUserBulkTest(TestCase):
+    url = '/api/accounts/blockuser/bulk/'
+
+    def setUp(self):
+        self.users = [User.objects.create(email=f'user{index}@kookmin.ac.kr', nickname=f'user{index}', name='user',
+                                          department='소프트웨어학부', student_number=20, gender='남')
+                      for index in range(4)]
+        self.user = self.users[0]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def post(self, action, users):
+        return self.client.post(self.url, {'action': action, 'users': users}, format='json')
+
+    def blocked(self):
+        return sorted(self.user.blocking.values_list('blocked_id', flat=True))
+
+    def test_block_and_unblock(self):
+        ids = [user.id for user in self.users[1:]]
+        # savepoint, the existence check, the insert, marking precomputed matches dirty,
+        # reading the list back and releasing the savepoint
+        with self.assertNumQueries(6):
+            response = self.post('block', ids)
+        self.assertEqual((response.status_code, response.data['block_user']), (200, ids))
+
+        with self.assertNumQueries(5):
+            response = self.post('unblock', ids[:2])
+        self.assertEqual(response.data['block_user'], ids[2:])
+        self.assertEqual(self.blocked(), ids[2:])
+
+        self.assertEqual(self.post('unblock', ids[:2]).status_code, 200)
+        self.assertEqual(self.blocked(), ids[2:])
+
+    def test_blocking_again_is_a_no_op(self):
+        UserBlock.objects.block(self.user, [self.users[1].id])
+        block = UserBlock.objects.get()
+        response = self.post('block', [self.users[1].id, self.users[2].id, self.users[1].id])
+        self.assertEqual(response.data['block_user'], [self.users[1].id, self.users[2].id])
+        self.assertEqual(UserBlock.objects.filter(blocker=self.user).count(), 2)
+        self.assertTrue(UserBlock.objects.filter(pk=block.pk).exists())
+
+    def test_invalid_ids_are_rejected(self):
+        for action, users in (('block', [self.user.id]), ('unblock', [self.user.id, self.users[1].id]),
+                              ('block', [self.users[1].id, 999]), ('block', []), ('mute', [self.users[1].id])):
+            self.assertEqual(self.post(action, users).status_code, 400, (action, users))
+        self.assertEqual(self.blocked(), [])
+
+
+class RatingStatisticsTest(TestCase):
+    def assert_matches_users(self):
+        stats = RatingStatistics.objects.current()
+        self.assertEqual((stats.total, stats.count), (sum(User.objects.values_list('rating', flat=True)),
+                                                       User.objects.count()))
+
+    def test_follows_rating_updates_and_deletes(self):
+        users = [User.objects.create(email=f'user{index}@kookmin.ac.kr', nickname=f'user{index}', name='user',
+                                     rating=Decimal(index)) for index in range(4)]
+        self.assert_matches_users()
+
+        client = APIClient()
+        client.force_authenticate(users[0])
+        for user, rating in ((users[1], '4.5'), (users[1], '0'), (users[3], '5')):
+            self.assertEqual(client.put('/api/accounts/rating/update/', {'user': user.id, 'rating': rating}).status_code,
+                             200)
+        self.assert_matches_users()
+
+        users[2].delete()
+        self.assert_matches_users()
+        blocked = User.objects.filter(id=users[3].id)
+        expected = sum(User.objects.exclude(id=users[3].id).values_list('rating', flat=True)) / 2
+        self.assertEqual(RatingStatistics.objects.mean(exclude=blocked), expected)
+
+        RatingStatistics.objects.filter(pk=1).update(total=0, count=0)
+        RatingStatistics.objects.rebuild()
+        self.assert_matches_users()
+
+
+class PrecomputedMatchTest(TestCase):
+    def create_user(self, index, rating):
+        user = User.objects.create(email=f'user{index}@kookmin.ac.kr', nickname=f'user{index}', name='user',
+                                   department='소프트웨어학부', student_number=20, gender='남', rating=Decimal(rating))
+        return user, TagSet.objects.create(owner=user, place='북악관', method='공부', person='동기')
+
+    def setUp(self):
+        self.users, self.tagsets = zip(*[self.create_user(index, index) for index in range(8)])
+        self.precompute()
+
+    def precompute(self, *args):
+        out = io.StringIO()
+        call_command('precompute_matches', '--workers', '1', *args, stdout=out)
+        return out.getvalue()
+
+    def search(self, tagset):
+        client = APIClient()
+        client.force_authenticate(tagset.owner)
+        return [tag['id'] for tag in client.get(f'/api/accounts/v2/user-search/{tagset.id}').data]
+
+    def dirty(self):
+        return set(PrecomputedMatch.objects.filter(is_dirty=True).values_list('tagset_id', flat=True))
+
+    def test_stores_and_serves_the_live_ranking(self):
+        tagset = self.tagsets[0]
+        stored = PrecomputedMatch.objects.fresh(tagset)
+        self.assertEqual([tag.id for tag in stored], [t.id for t in self.tagsets[7:3:-1]])
+        self.assertEqual(list(PrecomputedMatch.objects.filter(tagset=tagset).order_by('rank')
+                              .values_list('rank_key', flat=True)), [1100, 1000, 900, 800])
+        with mock.patch('accounts.views.get_matching_engine') as engine:
+            self.assertEqual(self.search(tagset), [tag.id for tag in stored])
+        engine.assert_not_called()
+
+        with self.settings(PRECOMPUTED_MATCH_TTL=0):
+            self.assertIsNone(PrecomputedMatch.objects.fresh(tagset))
+        PrecomputedMatch.objects.filter(tagset=tagset, rank=3).update(is_dirty=True)
+        self.assertIsNone(PrecomputedMatch.objects.fresh(tagset))
+        self.assertIn('for 1 tagsets', self.precompute())
+        self.assertIsNotNone(PrecomputedMatch.objects.fresh(tagset))
+
+    def test_only_ranking_changes_dirty_rows(self):
+        self.tagsets[7].introduction = 'hello'
+        self.tagsets[7].save()
+        self.assertEqual(self.dirty(), set())
+
+        # its own list, and every list it is in, which here is all of them
+        self.tagsets[3].method = '식사'
+        self.tagsets[3].save()
+        self.assertEqual(self.dirty(), {t.id for t in self.tagsets[3:]})
+
+    def test_new_tagset_dirties_the_lists_it_enters(self):
+        # scores at most 2 + 100 cents against everyone, below every stored 4th place
+        _, weak = self.create_user(8, 1)
+        weak.place, weak.method = '미래관', '식사'
+        weak.save()
+        self.assertEqual(self.dirty(), set())
+
+        # the 4th places are rating 4 for tagsets 0-3 and rating 3 for tagsets 4-7
+        _, strong = self.create_user(9, '3.50')
+        self.assertEqual(self.dirty(), {t.id for t in self.tagsets[4:]})
+        self.assertEqual(self.search(self.tagsets[7]), [t.id for t in self.tagsets[6:3:-1]] + [strong.id])
+        self.assertEqual(self.search(self.tagsets[0]), [t.id for t in self.tagsets[7:3:-1]])
+
+    def test_activation_and_rating_increase_dirty_rows(self):
+        inactive = self.tagsets[6]
+        inactive.is_active = False
+        inactive.save()
+        self.precompute()
+        self.assertEqual(self.dirty(), {inactive.id})
+        self.assertNotIn(inactive.id, self.search(self.tagsets[0]))
+
+        inactive.is_active = True
+        inactive.save()
+        self.assertIn(inactive.id, self.search(self.tagsets[0]))
+        self.precompute()
+        self.assertEqual(self.dirty(), set())
+
+        # rating 1 -> 3.50 passes the 4th place of tagsets 4-7 only
+        user = self.users[1]
+        user.rating = Decimal('3.50')
+        user.save()
+        self.assertEqual(self.dirty(), {self.tagsets[1].id} | {t.id for t in self.tagsets[4:]})
+        self.assertIn(self.tagsets[1].id, self.search(self.tagsets[7]))
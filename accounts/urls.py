@@ -15,14 +15,14 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from allauth.account.views import ConfirmEmailView
-from dj_rest_auth.views import PasswordResetConfirmView
+from dj_rest_auth.views import LoginView, PasswordResetConfirmView
 from django.urls import path, include, re_path
 from rest_framework import routers
 from rest_framework.authtoken.views import obtain_auth_token
 from .views import RatingUpdateView
 
 from accounts.views import UserDetailsViewOverride, UserViewSet, get_refresh_view, \
-    UserLogoutViewOverride, TagSetViewSet, UserSearch, BlockUserUpdateView, UserLoginViewOverride
+    UserLogoutViewOverride, TagSetViewSet, UserSearch, UserSearchPage, UserSearchBatch, BlockUserUpdateView, BlockUserBulkView
 
 router = routers.DefaultRouter()
 router.register(r'tagset', TagSetViewSet)
@@ -31,7 +31,8 @@ urlpatterns = [
     path('token/refresh/', get_refresh_view().as_view()),
     path('rating/update/', RatingUpdateView.as_view(), name='update_rating'),
     path('blockuser/update/', BlockUserUpdateView.as_view(), name='update_block_user'),
-    path('login/', UserLoginViewOverride.as_view(), name='login'),
+    path('blockuser/bulk/', BlockUserBulkView.as_view(), name='bulk_block_user'),
+    path('login/', LoginView.as_view(), name='login'),
     path('', include('dj_rest_auth.urls')),
     re_path(r'^register/account-confirm-email/(?P<key>[-:\w]+)/$', ConfirmEmailView.as_view(),
             name='account_confirm_email'),
@@ -44,6 +45,8 @@ urlpatterns = [
         path('user/me/', UserDetailsViewOverride.as_view(), name='rest_user_details'),
         path('user/detail/<int:pk>/', UserViewSet.as_view({'get': 'retrieve'})),
         path('logout/', UserLogoutViewOverride.as_view(), name='rest_logout'),
-        path('user-search/<int:id>', UserSearch.as_view(), name='rest_user_search')
+        path('user-search/batch', UserSearchBatch.as_view(), name='rest_user_search_batch'),
+        path('user-search/<int:id>', UserSearch.as_view(), name='rest_user_search'),
+        path('user-search/<int:id>/page', UserSearchPage.as_view(), name='rest_user_search_page')
     ]))
 ]
@@ -1,13 +1,14 @@
 import django_filters
-from django.db.models import Q
 from rest_framework import permissions
 from decimal import Decimal, getcontext
 from dj_rest_auth.app_settings import api_settings
 from django.shortcuts import get_object_or_404
 from dj_rest_auth.jwt_auth import set_jwt_access_cookie, set_jwt_refresh_cookie
-from dj_rest_auth.views import UserDetailsView, sensitive_post_parameters_m, LogoutView, LoginView
+from dj_rest_auth.views import UserDetailsView, sensitive_post_parameters_m, LogoutView
 from django.contrib.auth import get_user_model
 from django.contrib.auth.hashers import check_password 
+from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
 from django.http import HttpResponse
 from django_filters.rest_framework import DjangoFilterBackend
@@ -23,33 +24,23 @@ from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework.views import APIView
 from rest_framework import generics, permissions
 from rest_framework.schemas import ManualSchema
-import json
 
 from dj_rest_auth.views import PasswordResetConfirmView
 from django.utils.encoding import force_str
 from django.utils.http import urlsafe_base64_decode
 
 
-from accounts.models import User, TagSet
+from accounts.matching import get_matching_engine, fetch_in_order, candidate_pool
+from accounts.models import User, TagSet, RatingStatistics, PrecomputedMatch, UserBlock
+from accounts.recommendations import get_ranking, encode_cursor, decode_cursor, session_version
 from accounts.serializers import NewCookieTokenRefreshSerializer, UserSerializer, TagSetSerializer, NickNameSerializer, \
-    EmailSerializer, RatingUpdateSerializer, UserDeleteSerializer, BlockUserSerializer
+    EmailSerializer, RatingUpdateSerializer, UserDeleteSerializer, BlockUserSerializer, BlockUserBulkSerializer
 from utils.pagination import StandardResultsSetPagination
 
 
 class UserDetailsViewOverride(UserDetailsView):
     authentication_classes = [JWTAuthentication, SessionAuthentication, BasicAuthentication]
 
-class UserLoginViewOverride(LoginView):
-    def post(self, request, *args, **kwargs):
-        response = super().post(request, *args, **kwargs)
-        response_data = response
-        try:
-            block_user = json.loads(response.data['user']['block_user'].replace("\'", "\""))
-        except:
-            block_user = {"user":[]}
-        response_data.data['user']['block_user'] = block_user['user']
-        return response_data
-
 class UserLogoutViewOverride(LogoutView):
     def logout(self, request):
         devices = FCMDevice.objects.filter(user=request.user).delete()
@@ -106,13 +97,7 @@ class UserViewSet(ModelViewSet):
     def retrieve(self, request, *args, **kwargs):
         instance = self.get_object()
         serializer = UserSerializer(instance=instance)
-        try:
-            block_user = json.loads(serializer.data['block_user'].replace("\'", "\""))
-        except:
-            block_user = {"user":[]}
-        serializer_data = serializer.data
-        serializer_data['block_user'] = block_user['user']
-        return Response(serializer_data)
+        return Response(serializer.data)
 
     def destroy(self, request, *args, **kwargs):
         instance = self.get_object()
@@ -153,7 +138,7 @@ class RatingUpdateView(generics.UpdateAPIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        return get_user_model().objects.all()
+        return get_user_model().objects.select_for_update()
 
     def get_object(self):
         user_id = self.request.data.get('user', '')
@@ -161,11 +146,14 @@ class RatingUpdateView(generics.UpdateAPIView):
         obj = get_object_or_404(queryset, id=user_id)
         return obj
 
+    @transaction.atomic
     def put(self, request, *args, **kwargs):
         user = self.get_object()
         rating = request.data.get('rating', '')
-        user.rating = (Decimal(rating) + Decimal(user.rating)) / 2
+        old_rating = Decimal(user.rating or 0)
+        user.rating = ((Decimal(rating) + old_rating) / 2).quantize(Decimal('0.01'))
         user.save()
+        RatingStatistics.objects.add(user.rating - old_rating)
         response_data = {
             'user': user.id,
             'new_rating': user.rating,
@@ -223,118 +211,124 @@ class BlockUserUpdateView(generics.UpdateAPIView):
     def put(self, request, *args, **kwargs):
         user = self.get_object()
         block_user_id = request.data.get('block_user', '')
-        try:
-            block_user = json.loads(user.block_user.replace("\'", "\""))
-        except:
-            block_user = {"user":[]}
-        serializer_instance = BlockUserSerializer(data={'user':user, 'block_user':block_user_id})
-        is_valid = serializer_instance.is_valid()
-        serializer_instance.validate(serializer_instance.data)
-        block_user["user"].append(int(block_user_id))
-        user.block_user = json.dumps(block_user)
-        user.save()
+        serializer_instance = BlockUserSerializer(data={'user':user.id, 'block_user':block_user_id})
+        serializer_instance.is_valid(raise_exception=True)
+        UserBlock.objects.block(user, [serializer_instance.validated_data['block_user']])
         response_data = {
             'user': user.id,
-            'block_user': block_user["user"],
+            'block_user': list(user.blocking.values_list('blocked_id', flat=True)),
         }
         return Response(response_data)
 
-        
 
-class UserSearch(APIView):
-    def __init__(self):
-        self.tags = None
-        self.tags_score = dict()
 
+class BlockUserBulkView(generics.GenericAPIView):
+    """
+    Blocks or unblocks several users of the caller at once:
+    ``{"action": "block" | "unblock", "users": [ids]}``.
+    """
+    serializer_class = BlockUserBulkSerializer
+    permission_classes = [IsAuthenticated,]
+
+    @transaction.atomic
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        user = request.user
+        if serializer.validated_data['action'] == 'block':
+            UserBlock.objects.block(user, serializer.validated_data['users'])
+        else:
+            UserBlock.objects.unblock(user, serializer.validated_data['users'])
+        response_data = {
+            'user': user.id,
+            'block_user': list(user.blocking.values_list('blocked_id', flat=True)),
+        }
+        return Response(response_data)
+
+
+class UserSearch(APIView):
     def get(self, request, id):
         user = request.user
         user_tag = user.tagset_user.get(id=id)
-        try:
-            block_user = json.loads(user.block_user.replace("\'", "\""))
-        except:
-            block_user = {"user":[]}
-        users = User.objects.exclude(Q(id=user.id) | Q(id__in=block_user["user"]))
-        print(users)
-        self.tags = TagSet.objects.exclude(owner=user.id).exclude(is_active=False).exclude(owner__in=block_user["user"])
-
-        if len(self.tags) < 4:
-            seriallizer = TagSetSerializer(self.tags, many=True)
-            return Response(seriallizer.data)
-
-        rating_mean = 0
-        for u in users:
-            rating_mean += u.rating
-        rating_mean /= len(users)
-        for tag in self.tags:
-            self.tags_score[tag.id] = 0
-        place = user_tag.place
-        method = user_tag.method
-        self.fisrtTagCheck(place, method)
-        self.secondTagCheck(user_tag)
-        result_tags = self.recommend(rating_mean)
+        result_tags = PrecomputedMatch.objects.fresh(user_tag)
+        if result_tags is None:
+            tags = candidate_pool(user, user_tag)
+            result_tags = get_matching_engine().rank(user_tag, tags, limit=4)
         serializer = TagSetSerializer(result_tags, many=True)
         return Response(serializer.data)
 
-    def fisrtTagCheck(self, place, method):
-        equal_place_tags = self.tags.filter(place=place)
-        equal_method_tags = self.tags.filter(method=method)
-
-        for i in equal_method_tags:
-            self.tags_score[i.id] += 1
-
-        for i in equal_place_tags:
-            self.tags_score[i.id] += 1
-
-    def secondTagCheck(self, user_tag):
-        is_same_department = user_tag.isSameDepartment
-        for other_tag in self.tags:
-            is_same_other_department = other_tag.isSameDepartment
-            self.tagCheck(user_tag, other_tag, is_same_department, True)
-            self.tagCheck(other_tag, user_tag, is_same_other_department, False)
-
-    def tagCheck(self, user_tag, other_user_tag, is_same_department, is_check):
-        user_person = user_tag.person
-        user = User.objects.get(id=user_tag.owner_id)
-        user_student_number = user.student_number
-        user_department = user.department
-
-        other_user = User.objects.get(id=other_user_tag.owner_id)
-        other_user_department = other_user.department
-        other_user_student_number = User.objects.get(id=other_user_tag.owner_id).student_number
-
-        if is_same_department and user_department == other_user_department:
-            pass
-        elif not is_same_department and user_department != other_user_department:
-            pass
-        else:
-            return
-
-        if user_person == "선배":
-            if user_student_number > other_user_student_number and is_check:
-                self.tags_score[other_user_tag.id] += 1
-            elif user_student_number > other_user_student_number and not is_check:
-                self.tags_score[user_tag.id] += 1
-        elif user_person == "동기":
-            if user_student_number == other_user_student_number and is_check:
-                self.tags_score[other_user_tag.id] += 1
-            elif user_student_number == other_user_student_number and not is_check:
-                self.tags_score[user_tag.id] += 1
-        elif user_person == "후배":
-            if user_student_number < other_user_student_number and is_check:
-                self.tags_score[other_user_tag.id] += 1
-            elif user_student_number < other_user_student_number and not is_check:
-                self.tags_score[user_tag.id] += 1
+
+class UserSearchPage(UserSearch):
+    """
+    Hands out the ranking of a tagset page by page. The full ranking is cached
+    per (user, tagset) session, so following the ``next`` cursor is a slice.
+    A cursor from before the session was invalidated gets a 400, clients start over.
+    """
+    page_size = 4
+
+    def get(self, request, id):
+        user = request.user
+        user_tag = user.tagset_user.get(id=id)
+        cursor_version, offset = None, 0
+        cursor = request.query_params.get('cursor')
+        if cursor:
+            decoded = decode_cursor(cursor, user_tag.id)
+            if decoded is None:
+                return Response({'message': 'Invalid cursor'}, status=status.HTTP_400_BAD_REQUEST)
+            cursor_version, offset = decoded
+        # an offset only means something in the ranking it was handed out with
+        version = session_version(user.id, cursor_version)
+        if cursor_version is not None and cursor_version != version:
+            return Response({'message': 'Expired cursor'}, status=status.HTTP_400_BAD_REQUEST)
+
+        def build():
+            tags = candidate_pool(user, user_tag)
+            return get_matching_engine().ranking(user_tag, tags)
+
+        ranking = get_ranking(user.id, user_tag.id, build, version)
+        page = ranking[offset:offset + self.page_size]
+        next_offset = offset + len(page)
+        serializer = TagSetSerializer(fetch_in_order(page), many=True)
+        return Response({
+            'next': encode_cursor(user_tag.id, version, next_offset) if next_offset < len(ranking) else None,
+            'results': serializer.data,
+        })
+
+
+class UserSearchBatch(APIView):
+    """
+    Recommendations for several tagsets of the caller in one request.
+    ``?ids=1,2,3`` picks tagsets, ``?ids=all`` takes every active one.
+    """
+
+    def get(self, request):
+        user = request.user
+        ids = request.query_params.get('ids', 'all')
+        user_tags = user.tagset_user.select_related('owner')
+        if ids == 'all':
+            user_tags = user_tags.filter(is_active=True)
         else:
-            if is_check:
-                self.tags_score[other_user_tag.id] += 1
+            try:
+                user_tags = user_tags.filter(id__in=[int(i) for i in ids.split(',') if i])
+            except ValueError:
+                return Response({'message': 'Invalid ids'}, status=status.HTTP_400_BAD_REQUEST)
+
+        results = dict()
+        pending = list()
+        for user_tag in user_tags:
+            result_tags = PrecomputedMatch.objects.fresh(user_tag)
+            if result_tags is None:
+                pending.append(user_tag)
             else:
-                self.tags_score[user_tag.id] += 1
-
-    def recommend(self, rating_mean):
-        for tag in self.tags:
-            self.tags_score[tag.id] += tag.owner.rating - rating_mean
-        result_tag_list = list(dict(sorted(self.tags_score.items(), key=lambda x: x[1], reverse=True)))[:4]
-        result_tag = list()
-        for i in result_tag_list:
-            result_tag.append(TagSet.objects.filter(id=i)[0])
-        return result_tag
+                results[user_tag.id] = result_tags
+        if pending and settings.MATCHING_EXCLUDE_PAIRED_TAGSETS:
+            # the pool differs per tagset once paired tagsets are excluded
+            for user_tag in pending:
+                tags = candidate_pool(user, user_tag)
+                results[user_tag.id] = get_matching_engine().rank(user_tag, tags, limit=4)
+        elif pending:
+            tags = candidate_pool(user)
+            results.update(get_matching_engine().rank_many(pending, tags, limit=4))
+
+        return Response({str(tag_id): TagSetSerializer(result_tags, many=True).data
+                         for tag_id, result_tags in sorted(results.items())})
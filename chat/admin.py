@@ -3,7 +3,7 @@ from django.contrib.admin import ModelAdmin
 from django.contrib.auth.hashers import check_password, make_password
 
 from accounts.models import User
-from .models import Room, Message
+from .models import Room, Message, UnreadCount, UnreadBadge, SyncEvent, PushNotification
 
 
 # Register your models here.
@@ -18,3 +18,28 @@ class MessageAdmin(ModelAdmin):
     base_model = Message
     list_display = ['id', 'room', 'sender', 'receiver', 'is_read', 'type', 'args', 'message']
     search_fields = ["sender__email", "receiver__email"]
+
+
+@admin.register(UnreadCount)
+class UnreadCountAdmin(ModelAdmin):
+    base_model = UnreadCount
+    list_display = [field.name for field in UnreadCount._meta.fields]
+
+
+@admin.register(UnreadBadge)
+class UnreadBadgeAdmin(ModelAdmin):
+    base_model = UnreadBadge
+    list_display = [field.name for field in UnreadBadge._meta.fields]
+
+
+@admin.register(SyncEvent)
+class SyncEventAdmin(ModelAdmin):
+    base_model = SyncEvent
+    list_display = [field.name for field in SyncEvent._meta.fields]
+
+
+@admin.register(PushNotification)
+class PushNotificationAdmin(ModelAdmin):
+    base_model = PushNotification
+    list_display = ['id', 'receiver', 'message', 'status', 'attempts', 'next_attempt_at', 'last_error']
+    list_filter = ['status']
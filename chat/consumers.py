@@ -0,0 +1,28 @@
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+
+
+def user_group(user_id):
+    return f'chat.user.{user_id}'
+
+
+class ChatConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Pushes the changes of the user's rooms as they are committed, in the same shape
+    as /api/chat/sync/ entries, each with its sync watermark.
+    """
+
+    async def connect(self):
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated:
+            await self.close(code=4401)
+            return
+        self.group = user_group(user.id)
+        await self.channel_layer.group_add(self.group, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, code):
+        if hasattr(self, 'group'):
+            await self.channel_layer.group_discard(self.group, self.channel_name)
+
+    async def chat_event(self, event):
+        await self.send_json(event['payload'])
@@ -0,0 +1,51 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+from fcm_django.models import FCMDevice
+
+
+class Command(BaseCommand):
+    help = "Deletes duplicate and stale FCM devices in small batches: older registrations of the same " \
+           "device of a user, inactive devices, and devices whose owner has not logged in for --days days."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=90)
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--pause', type=float, default=0.0, help="seconds to sleep between batches")
+        parser.add_argument('--dry-run', action='store_true', help="only count what would be deleted")
+
+    def handle(self, *args, **options):
+        self.options = options
+        duplicates = self.prune(self.duplicates())
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        stale = self.prune(FCMDevice.objects.filter(
+            Q(active=False)
+            | Q(user__last_login__lt=cutoff)
+            | Q(user__last_login__isnull=True, date_created__lt=cutoff)
+        ))
+        verb = "Would delete" if options['dry_run'] else "Deleted"
+        self.stdout.write(self.style.SUCCESS(f"{verb} {duplicates} duplicate and {stale} stale devices"))
+
+    def duplicates(self):
+        """Every registration of a user's device (same device_id) but the newest"""
+        newer = FCMDevice.objects.filter(user=OuterRef('user'), device_id=OuterRef('device_id'), id__gt=OuterRef('id'))
+        return FCMDevice.objects.exclude(device_id__isnull=True).exclude(device_id='').filter(Exists(newer))
+
+    def prune(self, devices):
+        """Deletes ``devices`` in id order, --batch-size rows per short DELETE"""
+        deleted = 0
+        last = 0
+        while True:
+            ids = list(devices.filter(id__gt=last).order_by('id').values_list('id', flat=True)[:self.options['batch_size']])
+            if not ids:
+                return deleted
+            last = ids[-1]
+            if self.options['dry_run']:
+                deleted += len(ids)
+                continue
+            deleted += FCMDevice.objects.filter(id__in=ids).delete()[0]
+            if self.options['pause']:
+                time.sleep(self.options['pause'])
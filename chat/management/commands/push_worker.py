@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.models import PushNotification
+from chat.push import process
+
+
+class Command(BaseCommand):
+    help = "Delivers due push notifications from the outbox, retrying failed ones with backoff. " \
+           "Runs until stopped, or drains the due pushes once with --once."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true')
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--interval', type=float, default=1.0, help="seconds to wait when nothing is due")
+
+    def handle(self, *args, **options):
+        delivered = 0
+        while True:
+            due = PushNotification.objects.due(options['batch_size'])
+            for pk in due:
+                process(pk)
+            delivered += len(due)
+            if not due:
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+        self.stdout.write(self.style.SUCCESS(f"Processed {delivered} push notifications"))
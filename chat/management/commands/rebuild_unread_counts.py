@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from chat.models import UnreadCount
+
+
+class Command(BaseCommand):
+    help = "Recomputes the per-room unread counters and badge totals from the messages"
+
+    def handle(self, *args, **options):
+        UnreadCount.objects.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {UnreadCount.objects.count()} unread counters"))
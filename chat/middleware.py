@@ -0,0 +1,36 @@
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from django.contrib.auth.models import AnonymousUser
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError, AuthenticationFailed
+
+
+@database_sync_to_async
+def get_user(raw_token):
+    authentication = JWTAuthentication()
+    try:
+        return authentication.get_user(authentication.get_validated_token(raw_token))
+    except (InvalidToken, TokenError, AuthenticationFailed):
+        return AnonymousUser()
+
+
+class JWTAuthMiddleware:
+    """
+    Authenticates websocket connections with the API's access tokens, sent either as
+    ``Authorization: Bearer <token>`` or as ``?token=<token>`` for clients that
+    cannot set headers on the handshake.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        raw_token = parse_qs(scope.get('query_string', b'').decode()).get('token', [None])[0]
+        for name, value in scope.get('headers', []):
+            if name == b'authorization':
+                parts = value.decode().split()
+                if len(parts) == 2 and parts[0] == 'Bearer':
+                    raw_token = parts[1]
+        scope = dict(scope, user=await get_user(raw_token) if raw_token else AnonymousUser())
+        return await self.app(scope, receive, send)
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.3 on 2026-10-18 13:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_alter_message_options_room_latest_message'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='room',
+            index=models.Index(fields=['relation', 'relation2'], name='room_relation_pair_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='room',
+            index=models.Index(fields=['relation2', 'relation'], name='room_relation2_pair_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='room',
+            index=models.Index(fields=['tagset', 'tagset2'], name='room_tagset_pair_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='room',
+            index=models.Index(fields=['tagset2', 'tagset'], name='room_tagset2_pair_idx'),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 4.2.3 on 2026-10-18 14:15
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Sum
+import django.db.models.deletion
+
+
+def build_unread_counts(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    UnreadCount = apps.get_model('chat', 'UnreadCount')
+    UnreadBadge = apps.get_model('chat', 'UnreadBadge')
+    unread = Message.objects.filter(is_read=False).values('room_id', 'receiver_id').annotate(count=Count('id'))
+    UnreadCount.objects.bulk_create([UnreadCount(room_id=row['room_id'], user_id=row['receiver_id'], count=row['count'])
+                                     for row in unread])
+    badges = UnreadCount.objects.values('user_id').annotate(total=Sum('count'))
+    UnreadBadge.objects.bulk_create([UnreadBadge(user_id=row['user_id'], count=row['total']) for row in badges])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0004_room_pair_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnreadBadge',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='unread_badge', serialize=False, to=settings.AUTH_USER_MODEL, verbose_name='사용자')),
+                ('count', models.IntegerField(default=0, verbose_name='안 읽은 메시지 합계')),
+            ],
+            options={
+                'verbose_name': '안 읽은 메시지 합계',
+                'verbose_name_plural': '안 읽은 메시지 합계',
+            },
+        ),
+        migrations.CreateModel(
+            name='UnreadCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.IntegerField(default=0, verbose_name='안 읽은 메시지 수')),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='unread_counts', to='chat.room', verbose_name='채팅방')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='unread_counts', to=settings.AUTH_USER_MODEL, verbose_name='수신자')),
+            ],
+            options={
+                'verbose_name': '안 읽은 메시지 수',
+                'verbose_name_plural': '안 읽은 메시지 수',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='unreadcount',
+            constraint=models.UniqueConstraint(fields=('room', 'user'), name='unique_unread_count'),
+        ),
+        migrations.RunPython(build_unread_counts, migrations.RunPython.noop),
+    ]
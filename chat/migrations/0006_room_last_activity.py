@@ -0,0 +1,27 @@
+# Generated by Django 4.2.3 on 2026-10-18 14:40
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def fill_last_activity(apps, schema_editor):
+    Room = apps.get_model('chat', 'Room')
+    Message = apps.get_model('chat', 'Message')
+    Room.objects.filter(latest_message__isnull=False).update(
+        last_activity=Subquery(Message.objects.filter(pk=OuterRef('latest_message')).values('created')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_unread_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='last_activity',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='마지막 활동 시간'),
+        ),
+        migrations.RunPython(fill_last_activity, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.3 on 2026-10-18 15:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_room_last_activity'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='message',
+            options={'verbose_name': '메시지 관리', 'verbose_name_plural': '메시지 관리'},
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', 'created', 'id'], name='message_room_created_idx'),
+        ),
+    ]
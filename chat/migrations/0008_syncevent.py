@@ -0,0 +1,31 @@
+# Generated by Django 4.2.3 on 2026-10-18 15:30
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0007_message_room_created_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('message', '새 메시지'), ('room', '채팅방 변경'), ('read', '읽음')], max_length=10, verbose_name='변경 종류')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='생성 시간')),
+                ('message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chat.message', verbose_name='메시지')),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sync_events', to='chat.room', verbose_name='채팅방')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='읽은 사용자')),
+            ],
+            options={
+                'verbose_name': '동기화 로그',
+                'verbose_name_plural': '동기화 로그',
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.3 on 2026-10-18 16:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_syncevent'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('is_read', False)), fields=['room', 'receiver', 'id'], name='message_unread_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.3 on 2026-10-18 16:45
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import django_extensions.db.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0009_message_unread_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PushNotification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', django_extensions.db.fields.CreationDateTimeField(auto_now_add=True, verbose_name='created')),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(auto_now=True, verbose_name='modified')),
+                ('data', models.JSONField(default=dict, verbose_name='전송 데이터')),
+                ('devices', models.JSONField(blank=True, null=True, verbose_name='남은 장치')),
+                ('status', models.CharField(choices=[('pending', '대기'), ('sent', '전송 완료'), ('failed', '전송 실패')], default='pending', max_length=10, verbose_name='상태')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='시도 횟수')),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='다음 시도 시간')),
+                ('last_error', models.TextField(blank=True, default='', verbose_name='마지막 오류')),
+                ('message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='push_notifications', to='chat.message', verbose_name='메시지')),
+                ('receiver', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='push_notifications', to=settings.AUTH_USER_MODEL, verbose_name='수신자')),
+            ],
+            options={
+                'verbose_name': '푸시 알림 발송함',
+                'verbose_name_plural': '푸시 알림 발송함',
+                'indexes': [models.Index(fields=['status', 'next_attempt_at'], name='push_due_idx')],
+            },
+        ),
+    ]
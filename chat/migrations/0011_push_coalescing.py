@@ -0,0 +1,28 @@
+# Generated by Django 4.2.3 on 2026-10-18 17:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_pushnotification'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pushnotification',
+            name='room',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='push_notifications', to='chat.room', verbose_name='채팅방'),
+        ),
+        migrations.AddField(
+            model_name='pushnotification',
+            name='count',
+            field=models.PositiveIntegerField(default=1, verbose_name='메시지 수'),
+        ),
+        migrations.AddIndex(
+            model_name='pushnotification',
+            index=models.Index(fields=['receiver', 'room', 'status'], name='push_room_idx'),
+        ),
+    ]
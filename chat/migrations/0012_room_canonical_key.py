@@ -0,0 +1,62 @@
+# Generated by Django 4.2.3 on 2026-10-18 18:05
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+from django.db.models.functions import Greatest, Least
+
+KEY_FIELDS = ('min_user', 'max_user', 'min_tagset', 'max_tagset')
+
+
+def fill_room_keys(apps, schema_editor):
+    Room = apps.get_model('chat', 'Room')
+    Room.objects.update(min_user=Least('relation', 'relation2'), max_user=Greatest('relation', 'relation2'),
+                        min_tagset=Least('tagset', 'tagset2'), max_tagset=Greatest('tagset', 'tagset2'))
+    # rooms that duplicate an older one keep no key rather than being deleted with their messages
+    duplicates = Room.objects.values(*KEY_FIELDS).annotate(count=Count('id'), oldest=Min('id')).filter(count__gt=1)
+    for duplicate in duplicates:
+        Room.objects.filter(**{field: duplicate[field] for field in KEY_FIELDS}) \
+            .exclude(id=duplicate['oldest']).update(**{field: None for field in KEY_FIELDS})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_push_coalescing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='min_user',
+            field=models.BigIntegerField(blank=True, editable=False, null=True, verbose_name='관계자 키(작은 값)'),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='max_user',
+            field=models.BigIntegerField(blank=True, editable=False, null=True, verbose_name='관계자 키(큰 값)'),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='min_tagset',
+            field=models.BigIntegerField(blank=True, editable=False, null=True, verbose_name='태그셋 키(작은 값)'),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='max_tagset',
+            field=models.BigIntegerField(blank=True, editable=False, null=True, verbose_name='태그셋 키(큰 값)'),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='unique_pair',
+            field=models.BooleanField(default=False, editable=False, verbose_name='사용자 쌍 유일 여부'),
+        ),
+        migrations.RunPython(fill_room_keys, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='room',
+            constraint=models.UniqueConstraint(fields=('min_user', 'max_user', 'min_tagset', 'max_tagset'), name='unique_room_key'),
+        ),
+        migrations.AddConstraint(
+            model_name='room',
+            constraint=models.UniqueConstraint(condition=models.Q(('unique_pair', True)), fields=('min_user', 'max_user'), name='unique_room_pair'),
+        ),
+    ]
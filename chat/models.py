@@ -1,9 +1,17 @@
+from datetime import timedelta
+
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django_extensions.db.models import TimeStampedModel
-from django.db import models
-from django.db.models import Max
-from django.db.models.signals import post_save
+from django.db import models, transaction
+from django.db.models import Count, F, Max, Q, Sum
+from django.db.models.signals import post_save, post_delete, pre_save
 from django.dispatch import receiver
+from django.utils import timezone
+
+from accounts.models import PrecomputedMatch
+from accounts.recommendations import invalidate_user
+from .realtime import event_payload, publish
 
 
 class Room(TimeStampedModel):
@@ -19,14 +27,59 @@ class Room(TimeStampedModel):
     latest_message = models.OneToOneField('Message', verbose_name="가장 최근 메시지", null=True, blank=True,
                                           on_delete=models.SET_NULL, related_name="latest_message")
 
-    def update_latest_message(self):
-        latest_message = self.message_room.latest('created')
-        self.latest_message = latest_message
-        self.save()
+    last_activity = models.DateTimeField(null=True, blank=True, verbose_name="마지막 활동 시간")
+    # order-independent key of the participants and tagsets, kept up to date by set_room_key
+    min_user = models.BigIntegerField(null=True, blank=True, editable=False, verbose_name="관계자 키(작은 값)")
+    max_user = models.BigIntegerField(null=True, blank=True, editable=False, verbose_name="관계자 키(큰 값)")
+    min_tagset = models.BigIntegerField(null=True, blank=True, editable=False, verbose_name="태그셋 키(작은 값)")
+    max_tagset = models.BigIntegerField(null=True, blank=True, editable=False, verbose_name="태그셋 키(큰 값)")
+    # created with CHAT_UNIQUE_ROOM, at most one such room per pair of users
+    unique_pair = models.BooleanField(default=False, editable=False, verbose_name="사용자 쌍 유일 여부")
 
     class Meta:
         verbose_name_plural = "채팅방 관리"
         verbose_name = "채팅방 관리"
+        indexes = [
+            models.Index(fields=['relation', 'relation2'], name='room_relation_pair_idx'),
+            models.Index(fields=['relation2', 'relation'], name='room_relation2_pair_idx'),
+            models.Index(fields=['tagset', 'tagset2'], name='room_tagset_pair_idx'),
+            models.Index(fields=['tagset2', 'tagset'], name='room_tagset2_pair_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['min_user', 'max_user', 'min_tagset', 'max_tagset'],
+                                    name='unique_room_key'),
+            models.UniqueConstraint(fields=['min_user', 'max_user'], condition=Q(unique_pair=True),
+                                    name='unique_room_pair'),
+        ]
+
+    @staticmethod
+    def key(user, user2, tagset=None, tagset2=None):
+        """The canonical key of a room between two users (and tagsets), as lookup kwargs"""
+        key = dict(zip(('min_user', 'max_user'), sorted((int(user), int(user2)))))
+        if tagset is not None:
+            key.update(zip(('min_tagset', 'max_tagset'), sorted((int(tagset), int(tagset2)))))
+        return key
+
+
+class MessageManager(models.Manager):
+    def mark_read(self, room, user_id, up_to):
+        """
+        Marks the user's unread messages in ``room`` up to message id ``up_to`` read with one
+        UPDATE over the unread index, and sends the read receipt. Returns how many were marked.
+
+        ``up_to`` comes from the client, so the receipt names the newest message actually marked.
+        """
+        with transaction.atomic():
+            unread = self.filter(room=room, receiver=user_id, is_read=False, id__lte=up_to)
+            last = unread.aggregate(last=Max('id'))['last']
+            if last is None:
+                return 0
+            updated = unread.filter(id__lte=last).update(is_read=True)
+            if updated:
+                UnreadCount.objects.add(room.pk, user_id, -updated)
+                SyncEvent.objects.log((SyncEvent(kind=SyncEvent.READ, room=room, message_id=last, user_id=user_id),
+                                       (room.relation_id, room.relation2_id)))
+            return updated
 
 
 class Message(TimeStampedModel):
@@ -39,13 +92,244 @@ class Message(TimeStampedModel):
     is_read = models.BooleanField(verbose_name="읽음 여부", default=False)
     type = models.IntegerField(verbose_name="메세지 타입", default=1)
     args = models.TextField(verbose_name="인자값", default=None, null=True, blank=True)
+    objects = MessageManager()
+
+    class Meta:
+        verbose_name_plural = "메시지 관리"
+        verbose_name = "메시지 관리"
+        indexes = [
+            models.Index(fields=['room', 'created', 'id'], name='message_room_created_idx'),
+            models.Index(fields=['room', 'receiver', 'id'], condition=Q(is_read=False), name='message_unread_idx'),
+        ]
+
+
+class UnreadCountManager(models.Manager):
+    def add(self, room_id, user_id, delta):
+        """Adjusts the room counter and the user's badge total together"""
+        with transaction.atomic():
+            if not self.filter(room_id=room_id, user_id=user_id).update(count=F('count') + delta) and delta > 0:
+                self.get_or_create(room_id=room_id, user_id=user_id)
+                self.filter(room_id=room_id, user_id=user_id).update(count=F('count') + delta)
+            UnreadBadge.objects.add(user_id, delta)
+
+    def rebuild(self):
+        with transaction.atomic():
+            self.all().delete()
+            UnreadBadge.objects.all().delete()
+            unread = Message.objects.filter(is_read=False).values('room_id', 'receiver_id').annotate(count=Count('id'))
+            self.bulk_create([UnreadCount(room_id=row['room_id'], user_id=row['receiver_id'], count=row['count'])
+                              for row in unread])
+            badges = self.values('user_id').annotate(total=Sum('count'))
+            UnreadBadge.objects.bulk_create([UnreadBadge(user_id=row['user_id'], count=row['total'])
+                                             for row in badges])
+
+
+class UnreadCount(models.Model):
+    room = models.ForeignKey('Room', verbose_name="채팅방", on_delete=models.CASCADE, related_name="unread_counts")
+    user = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, verbose_name="수신자",
+                             related_name="unread_counts")
+    count = models.IntegerField(verbose_name="안 읽은 메시지 수", default=0)
+    objects = UnreadCountManager()
+
+    class Meta:
+        verbose_name_plural = "안 읽은 메시지 수"
+        verbose_name = "안 읽은 메시지 수"
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'user'], name='unique_unread_count'),
+        ]
+
+
+class UnreadBadgeManager(models.Manager):
+    def add(self, user_id, delta):
+        if not self.filter(user_id=user_id).update(count=F('count') + delta) and delta > 0:
+            self.get_or_create(user_id=user_id)
+            self.filter(user_id=user_id).update(count=F('count') + delta)
+
+    def total(self, user_id):
+        return self.filter(user_id=user_id).values_list('count', flat=True).first() or 0
+
+
+class UnreadBadge(models.Model):
+    user = models.OneToOneField(get_user_model(), on_delete=models.CASCADE, primary_key=True, verbose_name="사용자",
+                                related_name="unread_badge")
+    count = models.IntegerField(verbose_name="안 읽은 메시지 합계", default=0)
+    objects = UnreadBadgeManager()
+
+    class Meta:
+        verbose_name_plural = "안 읽은 메시지 합계"
+        verbose_name = "안 읽은 메시지 합계"
 
 
 @receiver(post_save, sender=Message)
-def update_latest_message(sender, instance, **kwargs):
-    instance.room.update_latest_message()
+def update_latest_message(sender, instance, created, raw=False, **kwargs):
+    # a single UPDATE guarded on the id, so concurrent sends can only move the pointer forward
+    if created and not raw:
+        Room.objects.filter(Q(latest_message__isnull=True) | Q(latest_message__lt=instance.pk),
+                            pk=instance.room_id).update(latest_message=instance.pk, last_activity=instance.created)
+
+
+class SyncEventManager(models.Manager):
+    def log(self, *entries):
+        """Saves ``(event, participant ids)`` pairs and pushes them to the participants once committed"""
+        events = self.bulk_create([event for event, _ in entries])
+        deliveries = [(user_ids, event_payload(event)) for event, (_, user_ids) in zip(events, entries)]
+        transaction.on_commit(lambda: publish(deliveries))
+        return events
+
+    def since(self, user_id, watermark, limit):
+        return list(self.filter(Q(room__relation=user_id) | Q(room__relation2=user_id), id__gt=watermark)
+                    .order_by('id')[:limit])
+
+
+class SyncEvent(models.Model):
+    """
+    Change log of the chat rooms. The id is the sync watermark, so the changes a
+    participant has not seen yet are one range scan from their last watermark.
+    """
+    MESSAGE = 'message'
+    ROOM = 'room'
+    READ = 'read'
+    KIND_CHOICES = (
+        (MESSAGE, '새 메시지'),
+        (ROOM, '채팅방 변경'),
+        (READ, '읽음'),
+    )
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, verbose_name="변경 종류")
+    room = models.ForeignKey('Room', verbose_name="채팅방", on_delete=models.CASCADE, related_name="sync_events")
+    # the new message, or the last message read
+    message = models.ForeignKey('Message', verbose_name="메시지", on_delete=models.CASCADE, null=True, blank=True,
+                                related_name="+")
+    user = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, verbose_name="읽은 사용자", null=True,
+                             blank=True, related_name="+")
+    created = models.DateTimeField(auto_now_add=True, verbose_name="생성 시간")
+    objects = SyncEventManager()
+
+    class Meta:
+        verbose_name_plural = "동기화 로그"
+        verbose_name = "동기화 로그"
+
+
+class PushNotificationManager(models.Manager):
+    def enqueue(self, receiver_id, data, message=None):
+        """
+        Stores a push for the receiver's devices, handed to the delivery pool once committed.
+
+        Pushes for the same room are coalesced: one still waiting for its first attempt takes
+        over the new message and counts it, and a room pushed less than PUSH_COALESCE_WINDOW
+        seconds ago waits out the window. A burst becomes one immediate push and one
+        collapsed push carrying the latest message and how many it stands for.
+        """
+        from .push import dispatch
+
+        room_id = message.room_id if message is not None else None
+        if room_id is not None and self.filter(receiver_id=receiver_id, room_id=room_id, attempts=0,
+                                               status=PushNotification.PENDING).update(
+                data=data, message=message, count=F('count') + 1, modified=timezone.now()):
+            return None
+
+        now = timezone.now()
+        window = timedelta(seconds=settings.PUSH_COALESCE_WINDOW)
+        recent = room_id is not None and self.filter(receiver_id=receiver_id, room_id=room_id,
+                                                     created__gte=now - window).exists()
+        notification = self.create(receiver_id=receiver_id, room_id=room_id, data=data, message=message,
+                                   next_attempt_at=now + window if recent else now)
+        delay = window.total_seconds() if recent else 0
+        transaction.on_commit(lambda: dispatch([notification.pk], delay))
+        return notification
+
+    def due(self, limit):
+        return list(self.filter(status=PushNotification.PENDING, next_attempt_at__lte=timezone.now())
+                    .order_by('next_attempt_at').values_list('id', flat=True)[:limit])
+
+    def claim(self, pk):
+        """
+        Leases a due push to the caller for PUSH_LEASE seconds with one conditional UPDATE,
+        so the request-side pool and push_worker never deliver the same row twice.
+        A worker that dies mid-delivery leaves it to be picked up again when the lease ends.
+        """
+        now = timezone.now()
+        return bool(self.filter(pk=pk, status=PushNotification.PENDING, next_attempt_at__lte=now).update(
+            next_attempt_at=now + timedelta(seconds=settings.PUSH_LEASE), attempts=F('attempts') + 1))
+
+
+class PushNotification(TimeStampedModel):
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, '대기'),
+        (SENT, '전송 완료'),
+        (FAILED, '전송 실패'),
+    )
+    receiver = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, verbose_name="수신자",
+                                 related_name="push_notifications")
+    room = models.ForeignKey('Room', verbose_name="채팅방", on_delete=models.CASCADE, null=True, blank=True,
+                             related_name="push_notifications")
+    # the latest of the ``count`` messages this push stands for
+    message = models.ForeignKey('Message', verbose_name="메시지", on_delete=models.CASCADE, null=True, blank=True,
+                                related_name="push_notifications")
+    count = models.PositiveIntegerField(default=1, verbose_name="메시지 수")
+    data = models.JSONField(verbose_name="전송 데이터", default=dict)
+    # devices still to deliver to after a partial failure, None for all the receiver's active devices
+    devices = models.JSONField(verbose_name="남은 장치", null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, verbose_name="상태")
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name="시도 횟수")
+    next_attempt_at = models.DateTimeField(default=timezone.now, verbose_name="다음 시도 시간")
+    last_error = models.TextField(blank=True, default="", verbose_name="마지막 오류")
+    objects = PushNotificationManager()
+
+    class Meta:
+        verbose_name_plural = "푸시 알림 발송함"
+        verbose_name = "푸시 알림 발송함"
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='push_due_idx'),
+            models.Index(fields=['receiver', 'room', 'status'], name='push_room_idx'),
+        ]
+
+
+@receiver(post_save, sender=Message)
+def log_message(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        SyncEvent.objects.log((SyncEvent(kind=SyncEvent.MESSAGE, room_id=instance.room_id, message=instance),
+                               (instance.sender_id, instance.receiver_id)))
+
+
+@receiver(post_save, sender=Room)
+def log_room(sender, instance, raw=False, **kwargs):
+    if not raw:
+        SyncEvent.objects.log((SyncEvent(kind=SyncEvent.ROOM, room=instance),
+                               (instance.relation_id, instance.relation2_id)))
+
+
+@receiver(post_save, sender=Message)
+def count_unread_message(sender, instance, created, raw=False, **kwargs):
+    if created and not raw and not instance.is_read:
+        UnreadCount.objects.add(instance.room_id, instance.receiver_id, 1)
+
+
+@receiver(post_delete, sender=Message)
+def uncount_unread_message(sender, instance, **kwargs):
+    if not instance.is_read:
+        UnreadCount.objects.add(instance.room_id, instance.receiver_id, -1)
+
+
+@receiver(pre_save, sender=Room)
+def set_room_key(sender, instance, raw=False, **kwargs):
+    # recomputed on every save, the participants and tagsets can change through the API;
+    # legacy duplicates the migration left without a key stay without one
+    if raw or not (instance._state.adding or instance.min_user is not None):
+        return
+    for field, value in Room.key(instance.relation_id, instance.relation2_id,
+                                 instance.tagset_id, instance.tagset2_id).items():
+        setattr(instance, field, value)
+    if instance._state.adding:
+        instance.unique_pair = settings.CHAT_UNIQUE_ROOM
 
 
-class Meta:
-    verbose_name_plural = "메시지 관리"
-    verbose_name = "메시지 관리"
+@receiver(post_save, sender=Room)
+def invalidate_partner_recommendations(sender, instance, created, raw=False, **kwargs):
+    # new chat partners leave each other's candidate pools
+    if created and not raw:
+        invalidate_user(instance.relation_id)
+        invalidate_user(instance.relation2_id)
+        PrecomputedMatch.objects.mark_dirty(owner__in=[instance.relation_id, instance.relation2_id])
@@ -0,0 +1,222 @@
+import logging
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.utils import timezone
+from fcm_django.models import FCMDevice
+from firebase_admin.exceptions import DeadlineExceededError, InternalError, InvalidArgumentError, UnavailableError
+from firebase_admin import messaging
+from firebase_admin.messaging import SenderIdMismatchError, UnregisteredError
+
+from utils.circuit_breaker import CircuitBreaker
+from .models import PushNotification
+
+logger = logging.getLogger(__name__)
+
+# errors after which fcm_django deactivates the device, retrying them is pointless
+PERMANENT_ERRORS = (UnregisteredError, SenderIdMismatchError, InvalidArgumentError)
+# errors that say firebase itself is struggling, counted as failures by the circuit breaker
+UNAVAILABLE_ERRORS = (UnavailableError, InternalError, DeadlineExceededError)
+
+PUSH_PAYLOAD_VERSION = '1'
+
+# tokens firebase accepts in one multicast message
+MULTICAST_LIMIT = 500
+
+executor = None
+
+
+def get_app():
+    return settings.FCM_DJANGO_SETTINGS['DEFAULT_FIREBASE_APP']
+
+
+def get_executor():
+    global executor
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=settings.PUSH_THREADS, thread_name_prefix='push')
+    return executor
+
+
+def dispatch(ids, delay=0):
+    """Delivers committed pushes on the in-process pool, push_worker picks up whatever it misses"""
+    if not settings.PUSH_THREADS:
+        return
+    if delay:
+        timer = threading.Timer(delay, dispatch, args=(ids,))
+        timer.daemon = True
+        timer.start()
+        return
+    for pk in ids:
+        get_executor().submit(run, pk)
+
+
+def run(pk):
+    try:
+        process(pk)
+    except Exception:
+        logger.exception("push %s could not be processed", pk)
+    finally:
+        connection.close()
+
+
+def backoff(attempts):
+    delay = min(settings.PUSH_RETRY_BASE * 2 ** (attempts - 1), settings.PUSH_RETRY_MAX)
+    return timedelta(seconds=delay * random.uniform(0.5, 1))
+
+
+def message_payload(message):
+    """
+    The push data for a chat message, version PUSH_PAYLOAD_VERSION. Only ids, the type and a
+    short preview are sent, clients fetch the message and room through the API when opened.
+    FCM data values have to be strings.
+    """
+    preview = message.message or ''
+    if len(preview) > settings.PUSH_PREVIEW_LENGTH:
+        preview = preview[:settings.PUSH_PREVIEW_LENGTH - 1] + '…'
+    return {
+        'v': PUSH_PAYLOAD_VERSION,
+        'message': str(message.pk),
+        'room': str(message.room_id),
+        'sender': str(message.sender_id),
+        'type': str(message.type),
+        'preview': preview,
+        'args': message.args or '',
+    }
+
+
+def build_message(notification, tokens):
+    data = dict(notification.data, count=str(notification.count))
+    collapse_key = f'room-{notification.room_id}' if notification.room_id else None
+    # a newer push for the room replaces the one still shown on the device
+    return messaging.MulticastMessage(
+        tokens=tokens,
+        data=data,
+        android=messaging.AndroidConfig(collapse_key=collapse_key) if collapse_key else None,
+        apns=messaging.APNSConfig(headers={'apns-collapse-id': collapse_key}) if collapse_key else None,
+    )
+
+
+class FirebaseTransport:
+    def send_each_for_multicast(self, message):
+        # send_multicast goes through the FCM batch endpoint, which Google has shut down
+        return messaging.send_each_for_multicast(message, app=get_app())
+
+
+class FakeTransport:
+    """
+    Keeps the multicast messages in ``sent`` instead of calling Firebase, for running and
+    testing offline. ``fail_with`` makes every call raise that exception and ``token_errors``
+    maps tokens to the error their response should carry.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.sent = list()
+        self.fail_with = None
+        self.token_errors = dict()
+
+    def send_each_for_multicast(self, message):
+        if self.fail_with is not None:
+            raise self.fail_with
+        self.sent.append(message)
+        return messaging.BatchResponse([
+            messaging.SendResponse(None, self.token_errors[token]) if token in self.token_errors
+            else messaging.SendResponse({'name': f'fake/{len(self.sent)}/{i}'}, None)
+            for i, token in enumerate(message.tokens)
+        ])
+
+
+PUSH_TRANSPORTS = {
+    'firebase': FirebaseTransport,
+    'fake': FakeTransport,
+}
+
+transports = dict()
+breakers = dict()
+
+
+def get_transport():
+    name = settings.PUSH_TRANSPORT
+    if name not in transports:
+        transports[name] = PUSH_TRANSPORTS[name]()
+    return transports[name]
+
+
+def get_breaker():
+    options = (settings.PUSH_BREAKER_FAILURE_RATE, settings.PUSH_BREAKER_MINIMUM_CALLS,
+               settings.PUSH_BREAKER_WINDOW, settings.PUSH_BREAKER_RESET)
+    if options not in breakers:
+        breakers[options] = CircuitBreaker(*options)
+    return breakers[options]
+
+
+def send(notification):
+    """
+    Sends to the remaining devices with one multicast message per MULTICAST_LIMIT tokens,
+    which Firebase delivers as one HTTP v1 request per token.
+
+    Returns the devices that failed temporarily, with their errors, and the devices that
+    were not tried because the circuit breaker is open.
+    """
+    devices = FCMDevice.objects.filter(user=notification.receiver_id, active=True)
+    if notification.devices is not None:
+        devices = devices.filter(id__in=notification.devices)
+    tokens = dict()
+    for device_id, token in devices.values_list('id', 'registration_id'):
+        tokens.setdefault(token, device_id)
+
+    breaker = get_breaker()
+    failed = dict()
+    deferred = list()
+    registration_ids = list(tokens)
+    for i in range(0, len(registration_ids), MULTICAST_LIMIT):
+        chunk = registration_ids[i:i + MULTICAST_LIMIT]
+        if not breaker.allow():
+            deferred += [tokens[token] for token in chunk]
+            continue
+        try:
+            responses = get_transport().send_each_for_multicast(build_message(notification, chunk)).responses
+        except Exception as e:
+            responses = [messaging.SendResponse(None, e) for _ in chunk]
+            breaker.record(False)
+        else:
+            breaker.record(not any(isinstance(response.exception, UNAVAILABLE_ERRORS) for response in responses))
+        FCMDevice.objects.deactivate_devices_with_error_results(chunk, responses)
+        for token, response in zip(chunk, responses):
+            if response.exception is not None and not isinstance(response.exception, PERMANENT_ERRORS):
+                failed[tokens[token]] = repr(response.exception)
+    return failed, deferred
+
+
+def process(pk):
+    """
+    Claims and delivers one due push. Devices that failed are retried with backoff, and
+    the ones skipped by an open circuit breaker wait for it without using up an attempt.
+    """
+    close_old_connections()
+    if not PushNotification.objects.claim(pk):
+        return
+    notification = PushNotification.objects.get(pk=pk)
+    failed, deferred = send(notification)
+    now = timezone.now()
+    if not failed and not deferred:
+        notification.status = PushNotification.SENT
+        notification.devices = None
+        notification.last_error = ""
+    else:
+        notification.devices = list(failed) + deferred
+        notification.last_error = "\n".join(failed.values()) if failed else "circuit open"
+        if not failed:
+            notification.attempts -= 1
+            notification.next_attempt_at = now + timedelta(seconds=get_breaker().retry_after())
+        elif notification.attempts >= settings.PUSH_MAX_ATTEMPTS:
+            notification.status = PushNotification.FAILED
+        else:
+            notification.next_attempt_at = now + backoff(notification.attempts)
+    notification.save(update_fields=['status', 'devices', 'attempts', 'last_error', 'next_attempt_at', 'modified'])
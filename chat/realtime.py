@@ -0,0 +1,54 @@
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from rest_framework.fields import DateTimeField
+
+from .consumers import user_group
+
+logger = logging.getLogger(__name__)
+
+
+def format_datetime(value):
+    return DateTimeField().to_representation(value) if value else None
+
+
+def event_payload(event):
+    """What the websocket sends for a SyncEvent, the same entry /api/chat/sync/ would return"""
+    payload = {'type': event.kind, 'watermark': event.id, 'room': event.room_id}
+    if event.kind == 'message':
+        message = event.message
+        payload['message'] = {
+            'id': message.id,
+            'created': format_datetime(message.created),
+            'room': message.room_id,
+            'sender': message.sender_id,
+            'receiver': message.receiver_id,
+            'message': message.message,
+            'is_read': message.is_read,
+            'type': message.type,
+            'args': message.args,
+        }
+    elif event.kind == 'room':
+        room = event.room
+        payload['reservation_time'] = format_datetime(room.reservation_time)
+        payload['latest_message'] = room.latest_message_id
+        payload['last_activity'] = format_datetime(room.last_activity)
+    else:
+        payload['user'] = event.user_id
+        payload['message'] = event.message_id
+    return payload
+
+
+def publish(deliveries):
+    """Sends ``(participant ids, payload)`` pairs to the participants' websocket groups"""
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    for user_ids, payload in deliveries:
+        for user_id in set(user_ids):
+            try:
+                async_to_sync(channel_layer.group_send)(user_group(user_id), {'type': 'chat.event', 'payload': payload})
+            except Exception:
+                # the change is committed and still reaches the client through /api/chat/sync/
+                logger.exception("websocket delivery to user %s failed", user_id)
@@ -1,29 +1,29 @@
-from django.db.models import Q
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
 from accounts.serializers import UserDetailSerializer, TagSetSerializer
-from .models import Room, Message
+from .models import Room, Message, UnreadCount
 from django.utils import timezone
 
+# Room's canonical key is internal, kept out of the API
+ROOM_KEY_FIELDS = ('min_user', 'max_user', 'min_tagset', 'max_tagset', 'unique_pair')
+
+
 class RoomWritableSerializer(serializers.ModelSerializer):
     class Meta:
         model = Room
-        fields = '__all__'
+        exclude = ROOM_KEY_FIELDS
 
     def validate(self, data):
         print(data['relation'])
         if data['relation'] == data['relation2']:
             raise ValidationError('같은 사용자로 채팅을 열 수 없습니다.')
 
-        if len(self.Meta.model.objects.filter(Q(relation=data["relation"],
-                                                tagset=data["tagset"],
-                                                relation2=data["relation2"],
-                                                tagset2=data["tagset2"])
-                                              | Q(relation2=data["relation"],
-                                                  tagset2=data["tagset"],
-                                                  relation=data["relation2"],
-                                                  tagset=data["tagset2"]))) > 0:
+        rooms = self.Meta.model.objects.filter(**Room.key(data["relation"].pk, data["relation2"].pk,
+                                                          data["tagset"].pk, data["tagset2"].pk))
+        if self.instance is not None:
+            rooms = rooms.exclude(pk=self.instance.pk)
+        if rooms.exists():
             raise ValidationError('같은 사용자와 태그로 채팅을 열 수 없습니다.')
         return super().validate(data)
 
@@ -59,6 +59,10 @@ class RoomReservationTimeSerializer(serializers.ModelSerializer):
         message.save()
     
 
+class ReadUpToSerializer(serializers.Serializer):
+    message = serializers.IntegerField(min_value=1)
+
+
 class MessageWritableSerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
@@ -84,18 +88,27 @@ class RoomSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Room
-        fields = '__all__'
+        exclude = ROOM_KEY_FIELDS
 
     def get_notice(self, obj):
+        if hasattr(obj, 'unread_count'):
+            return obj.unread_count
         request = self.context.get("request")
 
-        return obj.message_room.filter(receiver=request.user, is_read=False).count()
+        return UnreadCount.objects.filter(room=obj, user=request.user).values_list('count', flat=True).first() or 0
 
 
 class MessageWritableSerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
         fields = '__all__' 
+
+    def get_extra_kwargs(self):
+        extra_kwargs = super().get_extra_kwargs()
+        if self.instance is not None:
+            # reads go through the room's read action, which keeps the unread counters
+            extra_kwargs['is_read'] = dict(extra_kwargs.get('is_read', {}), read_only=True)
+        return extra_kwargs
         
 
 class MessageSerializer(serializers.ModelSerializer):
@@ -105,5 +118,6 @@ class MessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
         fields = '__all__'
+        read_only_fields = ('is_read',)
         ref_name = 'CustomMessage'
 
@@ -0,0 +1,611 @@
+import io
+from datetime import timedelta
+from unittest import mock
+
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from fcm_django.models import FCMDevice
+from firebase_admin.exceptions import UnavailableError
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from accounts.models import User, TagSet, UserBlock
+from utils.circuit_breaker import CircuitBreaker
+from .middleware import JWTAuthMiddleware
+from .models import Room, Message, UnreadCount, UnreadBadge, SyncEvent, PushNotification, update_latest_message
+from .push import FirebaseTransport, build_message, process, get_transport, get_breaker
+from .routing import websocket_urlpatterns
+from .views import RoomViewSet
+
+
+class ChatTestMixin:
+    def create_users(self, count, start=0, **fields):
+        return [User.objects.create(email=f'user{i}@kookmin.ac.kr', nickname=f'user{i}', name='user', **fields)
+                for i in range(start, start + count)]
+
+    def create_tagset(self, owner):
+        return TagSet.objects.create(owner=owner, place='북악관', method='공부', person='동기')
+
+    def create_room(self, user, other):
+        return Room.objects.create(relation=user, relation2=other,
+                                   tagset=self.create_tagset(user), tagset2=self.create_tagset(other))
+
+
+class RoomListQueryTest(ChatTestMixin, TestCase):
+    def create_user(self, index):
+        return self.create_users(1, start=index, department='소프트웨어학부', student_number=20, gender='남')[0]
+
+    def create_rooms(self, count):
+        for index in range(count):
+            other = self.create_user(len(self.users))
+            self.users.append(other)
+            UserBlock.objects.create(blocker=other, blocked=self.user)
+            room = self.create_room(self.user, other)
+            Message.objects.create(room=room, sender=other, receiver=self.user, message='hello')
+            Message.objects.create(room=room, sender=self.user, receiver=other, message='hi')
+
+    def setUp(self):
+        self.user = self.create_user(0)
+        self.users = [self.user]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_room_list_query_count_does_not_grow_with_rooms(self):
+        self.create_rooms(2)
+        with self.assertNumQueries(5):
+            response = self.client.get('/api/chat/room/')
+        self.assertEqual(len(response.data), 2)
+
+        self.create_rooms(10)
+        with self.assertNumQueries(5):
+            response = self.client.get('/api/chat/room/')
+        self.assertEqual(len(response.data), 12)
+        self.assertEqual(response.data[0]['notice'], 1)
+        self.assertEqual(response.data[0]['relation2']['block_user'], [self.user.id])
+
+    def test_room_retrieve_query_count(self):
+        self.create_rooms(1)
+        room = Room.objects.get()
+        with self.assertNumQueries(5):
+            response = self.client.get(f'/api/chat/room/{room.id}/')
+        self.assertEqual(response.data['latest_message']['message'], 'hi')
+
+
+class UnreadCountTest(ChatTestMixin, TestCase):
+    def setUp(self):
+        self.user, self.other = self.create_users(2)
+        self.rooms = [self.create_room(self.user, self.other) for _ in range(2)]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def send(self, room, count=1):
+        return [Message.objects.create(room=room, sender=self.other, receiver=self.user, message='hello')
+                for _ in range(count)]
+
+    def test_badge_follows_sent_and_read_messages(self):
+        self.send(self.rooms[0], 3)
+        messages = self.send(self.rooms[1], 2)
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/chat/unread/')
+        self.assertEqual(response.data, {'unread': 5})
+
+        # reading no longer writes, only the explicit read does
+        self.client.get('/api/chat/message/', {'room': self.rooms[0].id})
+        self.client.get(f'/api/chat/message/{messages[0].id}/')
+        self.assertEqual(self.client.get('/api/chat/unread/').data, {'unread': 5})
+
+        response = self.client.post(f'/api/chat/room/{self.rooms[1].id}/read/', {'message': messages[0].id})
+        self.assertEqual(response.data['updated'], 1)
+        response = self.client.post(f'/api/chat/room/{self.rooms[1].id}/read/', {'message': messages[0].id})
+        self.assertEqual(response.data['updated'], 0)
+        self.assertEqual(UnreadCount.objects.get(room=self.rooms[1], user=self.user).count, 1)
+
+        self.client.post(f'/api/chat/room/{self.rooms[0].id}/read/', {'message': messages[-1].id})
+        self.assertEqual(UnreadCount.objects.get(room=self.rooms[0], user=self.user).count, 0)
+        self.assertEqual(self.client.get('/api/chat/unread/').data, {'unread': 1})
+
+        self.client.force_authenticate(self.other)
+        self.assertEqual(self.client.get('/api/chat/unread/').data, {'unread': 0})
+
+    def test_read_is_one_update_and_scoped_to_participants(self):
+        messages = self.send(self.rooms[0], 3)
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(Message.objects.mark_read(self.rooms[0], self.user.id, messages[1].id), 2)
+        statements = [query['sql'] for query in captured if 'chat_message' in query['sql']]
+        # the newest unread id for the receipt, then the update
+        self.assertEqual([statement.split()[0] for statement in statements], ['SELECT', 'UPDATE'])
+        self.assertFalse(Message.objects.get(pk=messages[2].pk).is_read)
+
+        self.client.force_authenticate(self.create_users(1, start=2)[0])
+        response = self.client.post(f'/api/chat/room/{self.rooms[0].id}/read/', {'message': messages[2].id})
+        self.assertEqual(response.status_code, 404)
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.client.post(f'/api/chat/room/{self.rooms[0].id}/read/', {}).status_code, 400)
+
+    def test_read_receipt_names_a_marked_message(self):
+        messages = self.send(self.rooms[0], 2)
+        other_room = self.send(self.rooms[1])[0]
+        url = f'/api/chat/room/{self.rooms[0].id}/read/'
+        response = self.client.post(url, {'message': 999999})
+        self.assertEqual((response.status_code, response.data['updated']), (200, 2))
+        self.assertEqual(SyncEvent.objects.filter(kind=SyncEvent.READ).get().message_id, messages[-1].id)
+
+        # nothing left to mark, no receipt
+        self.assertEqual(self.client.post(url, {'message': other_room.id}).data['updated'], 0)
+        self.assertEqual(SyncEvent.objects.filter(kind=SyncEvent.READ).count(), 1)
+
+    def test_message_update_cannot_mark_read(self):
+        message = self.send(self.rooms[0])[0]
+        url = f'/api/chat/message/{message.id}/'
+        self.client.patch(url, {'is_read': True, 'message': 'edited'})
+        self.client.put(url, {'room': self.rooms[0].id, 'sender': self.other.id, 'receiver': self.user.id,
+                              'message': 'edited again', 'is_read': True})
+        message.refresh_from_db()
+        self.assertEqual((message.message, message.is_read), ('edited again', False))
+        self.assertEqual(self.client.get('/api/chat/unread/').data, {'unread': 1})
+
+    def test_rebuild_matches_counters(self):
+        self.send(self.rooms[0], 2)
+        Message.objects.filter(pk=self.send(self.rooms[1])[0].pk).delete()
+        counts = set(UnreadCount.objects.values_list('room', 'user', 'count'))
+        badge = UnreadBadge.objects.total(self.user.id)
+        UnreadCount.objects.rebuild()
+        self.assertEqual(set(UnreadCount.objects.filter(count__gt=0).values_list('room', 'user', 'count')),
+                         {c for c in counts if c[2]})
+        self.assertEqual(UnreadBadge.objects.total(self.user.id), badge)
+        self.assertEqual(badge, 2)
+
+
+class LatestMessageTest(ChatTestMixin, TestCase):
+    def setUp(self):
+        self.user, self.other = self.create_users(2)
+        self.room = self.create_room(self.user, self.other)
+
+    def test_latest_message_only_moves_forward(self):
+        first = Message.objects.create(room=self.room, sender=self.other, receiver=self.user, message='first')
+        second = Message.objects.create(room=self.room, sender=self.user, receiver=self.other, message='second',
+                                        is_read=True)
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.latest_message, second)
+        self.assertEqual(self.room.last_activity, second.created)
+
+        # a send that commits late must not move the pointer back
+        update_latest_message(Message, first, created=True)
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.latest_message, second)
+
+    def test_read_message_write_cost(self):
+        # insert, room pointer update, sync log entry
+        with self.assertNumQueries(3):
+            Message.objects.create(room=self.room, sender=self.user, receiver=self.other, is_read=True)
+
+
+class MessagePaginationTest(ChatTestMixin, TestCase):
+    def setUp(self):
+        self.user, self.other = self.create_users(2)
+        self.room = self.create_room(self.user, self.other)
+        self.messages = [Message.objects.create(room=self.room, sender=self.other, receiver=self.user,
+                                                message=str(i), is_read=True) for i in range(7)]
+        # equal timestamps fall back to the id
+        Message.objects.filter(pk__in=[m.pk for m in self.messages[2:5]]).update(created=self.messages[2].created)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def ids(self, response):
+        return [message['id'] for message in response.data['results']]
+
+    def test_walks_history_backwards_and_forwards(self):
+        ids = [m.id for m in self.messages]
+        response = self.client.get('/api/chat/message/', {'room': self.room.id, 'page_size': 3})
+        self.assertEqual(self.ids(response), ids[4:])
+        self.assertIsNone(response.data['next'])
+
+        response = self.client.get(response.data['previous'])
+        self.assertEqual(self.ids(response), ids[1:4])
+        older = self.client.get(response.data['previous'])
+        self.assertEqual(self.ids(older), ids[:1])
+        self.assertIsNone(older.data['previous'])
+
+        newer = self.client.get(older.data['next'])
+        self.assertEqual(self.ids(newer), ids[1:4])
+        newest = self.client.get(newer.data['next'])
+        self.assertEqual(self.ids(newest), ids[4:])
+        self.assertIsNone(newest.data['next'])
+
+    def test_plain_list_and_invalid_cursor(self):
+        self.assertEqual(len(self.client.get('/api/chat/message/').data), 7)
+        self.assertEqual(self.client.get('/api/chat/message/', {'before': 'nope'}).status_code, 404)
+
+    def test_query_count_does_not_grow_with_messages(self):
+        # the messages with both users joined, then one query per prefetched user relation
+        for count in (7, 20):
+            Message.objects.bulk_create([Message(room=self.room, sender=self.user, receiver=self.other, message='hi')
+                                         for _ in range(count - Message.objects.count())])
+            with self.assertNumQueries(5):
+                self.assertEqual(len(self.client.get('/api/chat/message/').data), count)
+            # plus the room the filter validates
+            with self.assertNumQueries(6):
+                response = self.client.get('/api/chat/message/', {'room': self.room.id, 'page_size': 10})
+            self.assertEqual(len(response.data['results']), min(count, 10))
+        with self.assertNumQueries(5):
+            response = self.client.get(f'/api/chat/message/{self.messages[0].id}/')
+        self.assertEqual(response.data['sender']['id'], self.other.id)
+
+
+class SyncTest(ChatTestMixin, TestCase):
+    def setUp(self):
+        self.user, self.other, self.stranger = self.create_users(3)
+        self.room = self.create_room(self.user, self.other)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def sync(self, since):
+        response = self.client.get('/api/chat/sync/', {'since': since})
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_returns_changes_since_watermark(self):
+        data = self.sync(0)
+        self.assertEqual([room['id'] for room in data['rooms']], [self.room.id])
+        watermark = data['watermark']
+        self.assertEqual(self.sync(watermark)['rooms'], [])
+
+        message = Message.objects.create(room=self.room, sender=self.other, receiver=self.user, message='hello')
+        data = self.sync(watermark)
+        self.assertEqual([m['id'] for m in data['messages']], [message.id])
+        self.assertEqual(data['rooms'][0]['latest_message']['id'], message.id)
+        self.assertEqual(data['rooms'][0]['notice'], 1)
+        watermark = data['watermark']
+
+        Message.objects.mark_read(self.room, self.user.id, message.id)
+        self.client.force_authenticate(self.other)
+        data = self.sync(watermark)
+        self.assertEqual(data['messages'], [])
+        self.assertEqual(data['reads'], [{'room': self.room.id, 'user': self.user.id, 'message': message.id}])
+
+        self.client.force_authenticate(self.stranger)
+        self.assertEqual(self.sync(0)['watermark'], 0)
+
+    def test_limit_and_invalid_watermark(self):
+        for i in range(3):
+            Message.objects.create(room=self.room, sender=self.other, receiver=self.user, message=str(i))
+        with self.settings(CHAT_SYNC_LIMIT=2):
+            data = self.sync(0)
+            self.assertTrue(data['has_more'])
+            data = self.sync(data['watermark'])
+            data = self.sync(data['watermark'])
+            self.assertFalse(data['has_more'])
+        self.assertEqual(data['watermark'], SyncEvent.objects.latest('id').id)
+        self.assertEqual(self.client.get('/api/chat/sync/', {'since': 'x'}).status_code, 400)
+
+
+class WebsocketTest(ChatTestMixin, TransactionTestCase):
+    application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+
+    def create_chat(self):
+        users = self.create_users(2)
+        return users, self.create_room(*users)
+
+    async def connect(self, path):
+        communicator = WebsocketCommunicator(self.application, path)
+        connected, code = await communicator.connect()
+        return communicator, connected, code
+
+    async def test_pushes_messages_and_read_receipts(self):
+        (user, other), room = await database_sync_to_async(self.create_chat)()
+        receiver, connected, _ = await self.connect(f'/ws/chat/?token={AccessToken.for_user(user)}')
+        self.assertTrue(connected)
+        sender, connected, _ = await self.connect(f'/ws/chat/?token={AccessToken.for_user(other)}')
+        self.assertTrue(connected)
+
+        message = await database_sync_to_async(Message.objects.create)(
+            room=room, sender=other, receiver=user, message='hello')
+        for communicator in (receiver, sender):
+            payload = await communicator.receive_json_from()
+            self.assertEqual(payload['type'], 'message')
+            self.assertEqual(payload['message']['message'], 'hello')
+
+        await database_sync_to_async(Message.objects.mark_read)(room, user.id, message.id)
+        payload = await sender.receive_json_from()
+        self.assertEqual((payload['type'], payload['user'], payload['message']), ('read', user.id, message.id))
+
+        await receiver.disconnect()
+        await sender.disconnect()
+
+    async def test_rejects_missing_or_invalid_token(self):
+        for path in ('/ws/chat/', '/ws/chat/?token=invalid'):
+            communicator, connected, code = await self.connect(path)
+            self.assertFalse(connected)
+            self.assertEqual(code, 4401)
+
+
+@override_settings(PUSH_THREADS=0, PUSH_TRANSPORT='fake')
+class PushOutboxTest(ChatTestMixin, TestCase):
+    def setUp(self):
+        self.user, self.other = self.create_users(2)
+        self.rooms = [self.create_room(self.user, self.other) for _ in range(2)]
+        self.devices = [FCMDevice.objects.create(user=self.other, registration_id=f'token{i}', type='android')
+                        for i in range(2)]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.transport = get_transport()
+        self.transport.reset()
+        get_breaker().reset()
+
+    def post_message(self, message='hello', room=0):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/chat/message/', {'room': self.rooms[room].id, 'sender': self.user.id,
+                                                               'receiver': self.other.id, 'message': message})
+        self.assertEqual(response.status_code, 201)
+        return response.data['id']
+
+    def make_due(self):
+        PushNotification.objects.update(next_attempt_at=timezone.now())
+
+    def test_create_only_enqueues(self):
+        message_id = self.post_message()
+        self.assertEqual(self.transport.sent, [])
+        notification = PushNotification.objects.get(message=message_id)
+        self.assertEqual(notification.status, PushNotification.PENDING)
+        self.assertEqual(notification.receiver, self.other)
+        self.assertEqual(notification.data, {'v': '1', 'message': str(message_id), 'room': str(self.rooms[0].id),
+                                             'sender': str(self.user.id), 'type': '1', 'preview': 'hello',
+                                             'args': ''})
+
+    def test_preview_is_truncated(self):
+        with self.settings(PUSH_PREVIEW_LENGTH=10):
+            self.post_message('a' * 50)
+        self.assertEqual(PushNotification.objects.get().data['preview'], 'a' * 9 + '…')
+
+    def test_one_multicast_per_receiver_and_retry_of_failed_devices(self):
+        self.post_message()
+        notification = PushNotification.objects.get()
+        self.transport.token_errors = {'token1': UnavailableError('unavailable', cause=None)}
+        process(notification.pk)
+        notification.refresh_from_db()
+        self.assertEqual(notification.status, PushNotification.PENDING)
+        self.assertEqual(notification.devices, [self.devices[1].id])
+        self.assertGreater(notification.next_attempt_at, timezone.now())
+
+        # not due yet
+        process(notification.pk)
+        self.assertEqual(len(self.transport.sent), 1)
+
+        self.transport.token_errors = dict()
+        self.make_due()
+        call_command('push_worker', '--once', stdout=io.StringIO())
+        notification.refresh_from_db()
+        self.assertEqual(notification.status, PushNotification.SENT)
+        self.assertEqual(notification.attempts, 2)
+        self.assertEqual([message.tokens for message in self.transport.sent], [['token0', 'token1'], ['token1']])
+        self.assertEqual(self.transport.sent[-1].android.collapse_key, f'room-{self.rooms[0].id}')
+
+    def test_firebase_transport_sends_each_token(self):
+        message = build_message(PushNotification(receiver=self.other, room=self.rooms[0], data={}), ['token0'])
+        with mock.patch('chat.push.messaging.send_each_for_multicast') as send_each, \
+                mock.patch('chat.push.messaging.send_multicast') as send_batch:
+            FirebaseTransport().send_each_for_multicast(message)
+        send_each.assert_called_once_with(message, app=mock.ANY)
+        send_batch.assert_not_called()
+
+    def test_burst_is_coalesced_per_room(self):
+        self.post_message('first')
+        process(PushNotification.objects.get().pk)
+
+        # within the window of the sent push: one delayed push for the rest of the burst
+        for message in ('second', 'third', 'fourth'):
+            self.post_message(message)
+        self.post_message('elsewhere', room=1)
+        pending = PushNotification.objects.get(status=PushNotification.PENDING, room=self.rooms[0])
+        self.assertEqual(pending.count, 3)
+        self.assertGreater(pending.next_attempt_at, timezone.now())
+        self.assertEqual(PushNotification.objects.filter(room=self.rooms[1]).count(), 1)
+
+        self.make_due()
+        process(pending.pk)
+        data = self.transport.sent[-1].data
+        self.assertEqual((data['preview'], data['count']), ('fourth', '3'))
+
+    def test_gives_up_after_max_attempts(self):
+        self.post_message()
+        notification = PushNotification.objects.get()
+        self.transport.fail_with = ConnectionError('timeout')
+        with self.settings(PUSH_MAX_ATTEMPTS=2):
+            for _ in range(3):
+                self.make_due()
+                process(notification.pk)
+        notification.refresh_from_db()
+        self.assertEqual(notification.status, PushNotification.FAILED)
+        self.assertEqual(notification.attempts, 2)
+        self.assertIn('timeout', notification.last_error)
+
+    @override_settings(PUSH_BREAKER_MINIMUM_CALLS=2, PUSH_BREAKER_RESET=30)
+    def test_open_circuit_defers_without_using_attempts(self):
+        self.transport.fail_with = UnavailableError('unavailable', cause=None)
+        for room in (0, 1):
+            self.post_message(room=room)
+        first, second = PushNotification.objects.order_by('id')
+        process(first.pk)
+        process(second.pk)
+        self.assertEqual(get_breaker().state, CircuitBreaker.OPEN)
+
+        # the request still succeeds right away, the push waits for the breaker
+        self.transport.fail_with = None
+        self.post_message('later', room=1)
+        self.make_due()
+        process(first.pk)
+        first.refresh_from_db()
+        self.assertEqual((first.status, first.attempts, first.last_error), (PushNotification.PENDING, 1, 'circuit open'))
+        self.assertGreater(first.next_attempt_at, timezone.now() + timedelta(seconds=20))
+        self.assertEqual(self.transport.sent, [])
+
+        # half-open: one probe goes through and closes the circuit
+        get_breaker().opened_at -= 30
+        self.make_due()
+        call_command('push_worker', '--once', stdout=io.StringIO())
+        self.assertEqual(get_breaker().state, CircuitBreaker.CLOSED)
+        self.assertFalse(PushNotification.objects.exclude(status=PushNotification.SENT).exists())
+
+
+class CircuitBreakerTest(SimpleTestCase):
+    def setUp(self):
+        self.now = 0
+        self.breaker = CircuitBreaker(failure_rate=0.5, minimum_calls=4, window=10, reset_timeout=5,
+                                      clock=lambda: self.now)
+
+    def test_opens_on_failure_rate_within_window(self):
+        for success in (True, False, True):
+            self.breaker.record(success)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        # the old outcomes leave the window
+        self.now = 11
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        for success in (False, True, False):
+            self.breaker.record(success)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.retry_after(), 5)
+
+    def test_half_open_lets_one_probe_through(self):
+        for _ in range(4):
+            self.breaker.record(False)
+        self.now = 5
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+        self.now = 10
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record(True)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+
+class PruneDevicesTest(ChatTestMixin, TestCase):
+    def test_prunes_duplicates_and_stale_devices_in_batches(self):
+        now = timezone.now()
+        active, idle, never = self.create_users(3)
+        User.objects.filter(pk=active.pk).update(last_login=now)
+        User.objects.filter(pk=idle.pk).update(last_login=now - timedelta(days=100))
+
+        def device(user, token, **kwargs):
+            return FCMDevice.objects.create(user=user, registration_id=token, type='android', **kwargs)
+
+        old_phone = [device(active, f'rotated{i}', device_id='phone') for i in range(3)]
+        phone = device(active, 'current', device_id='phone')
+        tablet = device(active, 'tablet', device_id='tablet')
+        device(active, 'disabled', active=False)
+        device(idle, 'idle')
+        new_user_device = device(never, 'fresh')
+        old_device = device(never, 'forgotten')
+        FCMDevice.objects.filter(pk=old_device.pk).update(date_created=now - timedelta(days=100))
+
+        out = io.StringIO()
+        call_command('prune_fcm_devices', '--dry-run', stdout=out)
+        self.assertIn('Would delete 3 duplicate and 3 stale devices', out.getvalue())
+        self.assertEqual(FCMDevice.objects.count(), 9)
+
+        with CaptureQueriesContext(connection) as captured:
+            call_command('prune_fcm_devices', '--batch-size', '2', stdout=out)
+        self.assertIn('Deleted 3 duplicate and 3 stale devices', out.getvalue())
+        self.assertEqual(set(FCMDevice.objects.values_list('id', flat=True)), {phone.id, tablet.id, new_user_device.id})
+        deletes = [query['sql'] for query in captured if query['sql'].startswith('DELETE')]
+        self.assertEqual(len(deletes), 4)
+        self.assertTrue(all(old.id not in FCMDevice.objects.values_list('id', flat=True) for old in old_phone))
+
+
+class RoomKeyTest(ChatTestMixin, TestCase):
+    def setUp(self):
+        self.user, self.other = self.create_users(2)
+        self.tagset = self.create_tagset(self.user)
+        self.tagset2 = self.create_tagset(self.other)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create(self, relation, relation2, tagset, tagset2):
+        return self.client.post('/api/chat/room/', {'relation': relation.id, 'relation2': relation2.id,
+                                                    'tagset': tagset.id, 'tagset2': tagset2.id})
+
+    def test_duplicate_room_is_rejected_in_either_order(self):
+        self.assertEqual(self.create(self.user, self.other, self.tagset, self.tagset2).status_code, 201)
+        room = Room.objects.get()
+        self.assertEqual((room.min_user, room.max_user), tuple(sorted((self.user.id, self.other.id))))
+        self.assertNotIn('min_user', self.client.get(f'/api/chat/room/{room.id}/').data)
+
+        with CaptureQueriesContext(connection) as captured:
+            response = self.create(self.other, self.user, self.tagset2, self.tagset)
+        self.assertEqual(response.status_code, 400)
+        lookups = [query['sql'] for query in captured if 'FROM "chat_room"' in query['sql']]
+        self.assertEqual(len(lookups), 1)
+        self.assertIn('"min_user"', lookups[0])
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Room.objects.create(relation=self.other, relation2=self.user, tagset=self.tagset2, tagset2=self.tagset)
+
+    def test_key_follows_updated_tagsets(self):
+        self.assertEqual(self.create(self.user, self.other, self.tagset, self.tagset2).status_code, 201)
+        room = Room.objects.get()
+        tagset3 = self.create_tagset(self.other)
+        data = {'relation': self.user.id, 'relation2': self.other.id, 'tagset': self.tagset.id, 'tagset2': tagset3.id}
+        self.assertEqual(self.client.put(f'/api/chat/room/{room.id}/', data).status_code, 200)
+        room.refresh_from_db()
+        self.assertEqual((room.min_tagset, room.max_tagset), tuple(sorted((self.tagset.id, tagset3.id))))
+
+        # the old pair of tagsets is free again, and the new one is taken
+        self.assertEqual(self.create(self.user, self.other, self.tagset, self.tagset2).status_code, 201)
+        data['tagset2'] = self.tagset2.id
+        self.assertEqual(self.client.put(f'/api/chat/room/{room.id}/', data).status_code, 400)
+
+        # a save that keeps the pair is not a duplicate of itself
+        data['tagset2'] = tagset3.id
+        self.assertEqual(self.client.put(f'/api/chat/room/{room.id}/', data).status_code, 200)
+
+    def test_legacy_duplicate_stays_without_key(self):
+        room = Room.objects.create(relation=self.user, relation2=self.other, tagset=self.tagset, tagset2=self.tagset2)
+        duplicate = Room.objects.create(relation=self.other, relation2=self.user, tagset=self.create_tagset(self.other),
+                                        tagset2=self.tagset)
+        Room.objects.filter(pk=duplicate.pk).update(tagset2=self.tagset2, tagset=self.tagset, min_user=None,
+                                                    max_user=None, min_tagset=None, max_tagset=None)
+        duplicate.refresh_from_db()
+        keys = ('min_user', 'max_user', 'min_tagset', 'max_tagset')
+        room_keys = Room.objects.filter(pk=room.pk).values(*keys).get()
+        self.assertNotIn(None, room_keys.values())
+
+        # saving the duplicate must not claim the key the existing room holds
+        duplicate.reservation_time = timezone.now()
+        duplicate.save()
+        duplicate.refresh_from_db()
+        self.assertIsNotNone(duplicate.reservation_time)
+        self.assertEqual([getattr(duplicate, key) for key in keys], [None] * 4)
+
+        room.reservation_time = timezone.now()
+        room.save()
+        self.assertEqual(Room.objects.filter(pk=room.pk).values(*keys).get(), room_keys)
+        self.assertEqual(Room.objects.filter(pk=duplicate.pk).values(*keys).get(), dict.fromkeys(keys))
+
+    @override_settings(CHAT_UNIQUE_ROOM=True)
+    def test_unique_room_per_pair(self):
+        self.assertEqual(self.create(self.user, self.other, self.tagset, self.tagset2).status_code, 201)
+        other_tagset = TagSet.objects.create(owner=self.other, place='미래관', method='밥', person='선배')
+        response = self.create(self.other, self.user, other_tagset, self.tagset)
+        self.assertEqual((response.status_code, response.data['id']), (200, Room.objects.get().id))
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Room.objects.create(relation=self.other, relation2=self.user, tagset=other_tagset, tagset2=self.tagset)
+
+    @override_settings(CHAT_UNIQUE_ROOM=True)
+    def test_simultaneous_create_returns_the_winning_room(self):
+        winner = Room.objects.create(relation=self.other, relation2=self.user, tagset=self.tagset2, tagset2=self.tagset)
+        # the losing request looked before the winner committed
+        with mock.patch.object(RoomViewSet, 'find_room', side_effect=[None, winner]):
+            response = self.create(self.user, self.other, TagSet.objects.create(owner=self.user), self.tagset2)
+        self.assertEqual((response.status_code, response.data['id']), (200, winner.id))
+        self.assertEqual(Room.objects.count(), 1)
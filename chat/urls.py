@@ -20,7 +20,7 @@ from rest_framework import routers
 from rest_framework.authtoken.views import obtain_auth_token
 
 from accounts.views import UserDetailsViewOverride
-from .views import RoomViewSet, MessageViewSet
+from .views import RoomViewSet, MessageViewSet, UnreadBadgeView, SyncView
 
 # from gamept.views import RequestViewSet
 
@@ -28,5 +28,7 @@ router = routers.DefaultRouter()
 router.register('room', RoomViewSet)
 router.register('message', MessageViewSet)
 urlpatterns = [
+    path('unread/', UnreadBadgeView.as_view()),
+    path('sync/', SyncView.as_view()),
     path('', include(router.urls))
 ]
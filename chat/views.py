@@ -1,21 +1,25 @@
-import json
-import firebase_admin
 
 from collections import OrderedDict
-from django.db.models import Q
+from django.db import IntegrityError, transaction
+from django.db.models import OuterRef, Q, Subquery, Value, prefetch_related_objects
+from django.db.models.functions import Coalesce
 from django_filters.rest_framework import DjangoFilterBackend
-from fcm_django.models import FCMDevice
 from firebase_admin.messaging import Notification
 from rest_framework import viewsets, status
+from rest_framework.decorators import action
 from rest_framework.authentication import SessionAuthentication, BasicAuthentication, TokenAuthentication
+from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
+from rest_framework.views import APIView
 from rest_framework_simplejwt.authentication import JWTAuthentication
 
-from utils.pagination import StandardResultsSetPagination
-from .models import Room, Message
+from accounts.serializers import USER_PREFETCH
+from utils.pagination import StandardResultsSetPagination, KeysetPagination
+from .models import Room, Message, UnreadCount, UnreadBadge, SyncEvent, PushNotification
+from .push import message_payload
 from .serializers import RoomSerializer, MessageSerializer, MessageWritableSerializer, RoomWritableSerializer, \
-    RoomReservationTimeSerializer
+    RoomReservationTimeSerializer, ReadUpToSerializer
 
 from django.conf import settings
 
@@ -32,6 +36,8 @@ class RoomViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         queryset = Room.objects.filter(Q(relation=self.request.user.id) | Q(relation2=self.request.user.id))
+        if self.action in ["list", "retrieve"]:
+            queryset = with_room_details(queryset, self.request.user.id)
         return queryset
 
     def get_serializer_class(self):
@@ -42,90 +48,92 @@ class RoomViewSet(viewsets.ModelViewSet):
         return self.serializer_class
 
     def create(self, request, *args, **kwargs):
-        if settings.CHAT_UNIQUE_ROOM:
-            chat = self.queryset.filter(
-                Q(relation=request.data['relation']) & Q(relation2=request.data['relation2']) | Q(
-                    relation2=request.data['relation']) & Q(relation=request.data['relation2']))
-            if len(chat) > 0:
-                serializer = self.get_serializer(chat[0])
-                res_status = status.HTTP_200_OK
-            else:
-                serializer = self.get_serializer(data=request.data)
-                serializer.is_valid(raise_exception=True)
-
-                serializer.save(relation=request.user)
-                res_status = status.HTTP_201_CREATED
-
-        else:
+        room = self.find_room(request.data) if settings.CHAT_UNIQUE_ROOM else None
+        if room is None:
             serializer = self.get_serializer(data=request.data)
             serializer.is_valid(raise_exception=True)
-
-            serializer.save(relation=request.user)
-            res_status = status.HTTP_201_CREATED
+            try:
+                with transaction.atomic():
+                    serializer.save(relation=request.user)
+                res_status = status.HTTP_201_CREATED
+            except IntegrityError:
+                # a simultaneous request created the same room first
+                room = self.find_room(request.data) if settings.CHAT_UNIQUE_ROOM else None
+                if room is None:
+                    raise ValidationError('같은 사용자와 태그로 채팅을 열 수 없습니다.')
+        if room is not None:
+            serializer = self.get_serializer(room)
+            res_status = status.HTTP_200_OK
 
         headers = self.get_success_headers(serializer.data)
         return Response(serializer.data, status=res_status, headers=headers)
 
+    def perform_update(self, serializer):
+        try:
+            with transaction.atomic():
+                serializer.save()
+        except IntegrityError:
+            # the new participants or tagsets collide with a room saved since validation
+            raise ValidationError('같은 사용자와 태그로 채팅을 열 수 없습니다.')
+
+    def find_room(self, data):
+        """The room between the two users, one probe of the room key index"""
+        try:
+            key = Room.key(data['relation'], data['relation2'])
+        except (KeyError, TypeError, ValueError):
+            return None
+        return self.queryset.filter(**key).order_by('id').first()
+
+    @action(detail=True, methods=['post'])
+    def read(self, request, *args, **kwargs):
+        """Marks the user's messages in the room read up to ``message``"""
+        room = self.get_object()
+        serializer = ReadUpToSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        message = serializer.validated_data['message']
+        updated = Message.objects.mark_read(room, request.user.id, message)
+        return Response({'room': room.id, 'message': message, 'updated': updated})
+
     def list(self, request, *args, **kwargs):
         queryset = self.filter_queryset(self.get_queryset())
         # queryset.filter(receiver=self.request.user.id)
         # queryset.filter(receiver=self.request.user.id, is_read=False).update(is_read=True)
-        serializer = self.get_serializer(queryset, many=True)
-        serializer_data = serializer.data
-        for index, data in enumerate(serializer.data):
-            try:
-                relation1 = json.loads(data['relation']['block_user'].replace("\'", "\""))
-                last_msg_sender = json.loads(data['lastest_message']['sender']['block_user']).replace("\'", "\"")
-            except:
-                relation1 = {"user":[]}
-                last_msg_sender = {"user":[]}
-            try:
-                relation2 = json.loads(data['relation2']['block_user'].replace("\'", "\""))
-                last_msg_receiver = json.loads(data['lastest_message']['receiver']['block_user']).replace("\'", "\"")
-            except:
-                relation2 = {"user":[]}
-                last_msg_receiver = {"user":[]}
-            serializer_data[index]['relation']['block_user'] = relation1['user']
-            serializer_data[index]['relation2']['block_user'] = relation2['user']
-            try:
-                serializer_data[index]['latest_message']['sender']['block_user'] = last_msg_sender['user']
-                serializer_data[index]['latest_message']['receiver']['block_user'] = last_msg_receiver['user']
-            except:
-                serializer_data[index]['latest_message'] = None
-        return Response(serializer_data)
+        rooms = list(queryset)
+        prefetch_room_users(rooms)
+        serializer = self.get_serializer(rooms, many=True)
+        return Response(serializer.data)
 
     def retrieve(self, request, *args, **kwargs):
         instance = self.get_object()
-        instance.save()
+        prefetch_room_users([instance])
         serializer = self.get_serializer(instance)
-        serializer_data = serializer.data
-        try:
-            relation1 = json.loads(serializer.data['relation']['block_user'].replace("\'", "\""))
-            last_msg_sender = json.loads(serializer.data['latest_message']['sender']['block_user']).replace("\'", "\"")
-        except:
-            relation1 = {"user":[]}
-            last_msg_sender = {"user":[]}
-        try:
-            relation2 = json.loads(serializer.data['relation2']['block_user'].replace("\'", "\""))
-            last_msg_receiver = json.loads(serializer.data['latest_message']['receiver']['block_user']).replace("\'", "\"")
-        except:
-            relation2 = {"user":[]}
-            last_msg_receiver = {"user":[]}
-        print(last_msg_sender)
-        serializer_data['relation']['block_user'] = relation1['user']
-        serializer_data['relation2']['block_user'] = relation2['user']
-        try:
-            serializer_data['latest_message']['sender']['block_user'] = last_msg_sender['user']
-            serializer_data['latest_message']['receiver']['block_user'] = last_msg_receiver['user']
-        except:
-            serializer_data['latest_message'] = None
-        return Response(serializer_data)
+        return Response(serializer.data)
+
+
+def with_room_details(queryset, user_id):
+    """Joins what RoomSerializer renders and annotates the user's unread count"""
+    return queryset.select_related(
+        'relation', 'relation2', 'tagset', 'tagset2', 'latest_message__sender', 'latest_message__receiver'
+    ).annotate(
+        unread_count=Coalesce(Subquery(UnreadCount.objects.filter(
+            room=OuterRef('pk'), user=user_id).values('count')[:1]), Value(0))
+    )
+
 
-def convertValueString(data: dict):
-    ret = {}
-    for key in data.keys():
-        ret[key] = json.dumps(data[key])
-    return ret
+def prefetch_room_users(rooms):
+    """Loads the nested users' relations of all rooms with one query per relation"""
+    users = list()
+    for room in rooms:
+        users += [room.relation, room.relation2]
+        if room.latest_message is not None:
+            users += [room.latest_message.sender, room.latest_message.receiver]
+    prefetch_related_objects(users, *USER_PREFETCH)
+
+
+def prefetch_message_users(messages):
+    """Loads the senders' and receivers' relations of all messages with one query per relation"""
+    prefetch_related_objects([user for message in messages for user in (message.sender, message.receiver)],
+                             *USER_PREFETCH)
 
 
 class MessageViewSet(viewsets.ModelViewSet):
@@ -137,10 +145,11 @@ class MessageViewSet(viewsets.ModelViewSet):
     filterset_fields = ['room__id', 'room']
     ordering_fields = [field.name for field in Message._meta.fields]
     ordering = ('created',)
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         queryset = Message.objects.filter(Q(sender=self.request.user.id) | Q(receiver=self.request.user.id))
-        return queryset
+        return queryset.select_related('sender', 'receiver')
 
     def get_serializer_class(self):
         if self.action in ["create", "update"]:
@@ -149,54 +158,73 @@ class MessageViewSet(viewsets.ModelViewSet):
 
     def list(self, request, *args, **kwargs):
         queryset = self.filter_queryset(self.get_queryset())
-        queryset.filter(receiver=self.request.user.id, is_read=False).update(is_read=True)
-    
-        serializer = self.get_serializer(queryset, many=True)
-        serializer_data = serializer.data
-        for index, data in enumerate(serializer.data):
-            try:
-                sender = json.loads(data['sender']['block_user'].replace("\'", "\""))
-            except:
-                sender = {"user":[]}
-            try:
-                receiver = json.loads(data['receiver']['block_user'].replace("\'", "\""))
-            except:
-                receiver = {"user":[]}
-            serializer_data[index]['sender']['block_user'] = sender['user']
-            serializer_data[index]['receiver']['block_user'] = receiver['user']
-        return Response(serializer_data)
+        # before/after/page_size switch to cursor pages, plain requests keep the full list
+        if self.paginator.is_requested(request):
+            page = self.paginate_queryset(queryset)
+            prefetch_message_users(page)
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+        messages = list(queryset)
+        prefetch_message_users(messages)
+        serializer = self.get_serializer(messages, many=True)
+        return Response(serializer.data)
 
     def retrieve(self, request, *args, **kwargs):
         instance = self.get_object()
-        instance.is_read = True
-        instance.save()
+        prefetch_message_users([instance])
         serializer = self.get_serializer(instance)
-        serializer_data = serializer.data
-        print(serializer_data)
-        try:
-            sender = json.loads(serializer.data['sender']['block_user'].replace("\'", "\""))
-        except:
-            sender = {"user":[]}
-        try:
-            receiver = json.loads(serializer.data['receiver']['block_user'].replace("\'", "\""))
-        except:
-            receiver = {"user":[]}
-        serializer_data['sender']['block_user'] = sender['user']
-        serializer_data['receiver']['block_user'] = receiver['user']
         return Response(serializer.data)
 
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        obj = serializer.save(sender=request.user)
-        devices = FCMDevice.objects.filter(user=obj.receiver)
-
-        for device in devices:
-            device.send_message(
-                firebase_admin.messaging.Message(
-                    data=convertValueString(serializer.data),
-                )
-            )
+        with transaction.atomic():
+            obj = serializer.save(sender=request.user)
+            PushNotification.objects.enqueue(obj.receiver_id, message_payload(obj), message=obj)
 
         headers = self.get_success_headers(serializer.data)
         return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
+
+
+class UnreadBadgeView(APIView):
+    authentication_classes = [JWTAuthentication, SessionAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        return Response({"unread": UnreadBadge.objects.total(request.user.id)})
+
+
+class SyncView(APIView):
+    """
+    Changes of the user's rooms since ``?since=<watermark>``: new messages, rooms whose
+    reservation or latest message changed, and read receipts, plus the next watermark.
+    """
+    authentication_classes = [JWTAuthentication, SessionAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        try:
+            watermark = int(request.query_params.get('since', 0))
+        except ValueError:
+            raise ValidationError({'since': 'since must be an integer watermark'})
+
+        events = SyncEvent.objects.since(request.user.id, watermark, settings.CHAT_SYNC_LIMIT + 1)
+        has_more = len(events) > settings.CHAT_SYNC_LIMIT
+        events = events[:settings.CHAT_SYNC_LIMIT]
+
+        message_ids = [event.message_id for event in events if event.kind == SyncEvent.MESSAGE]
+        room_ids = {event.room_id for event in events if event.kind in (SyncEvent.MESSAGE, SyncEvent.ROOM)}
+        messages = list(Message.objects.filter(id__in=message_ids).select_related('sender', 'receiver').order_by('id'))
+        rooms = list(with_room_details(Room.objects.filter(id__in=room_ids), request.user.id).order_by('id'))
+        prefetch_room_users(rooms)
+        prefetch_message_users(messages)
+
+        context = {'request': request}
+        return Response(OrderedDict([
+            ('watermark', events[-1].id if events else watermark),
+            ('has_more', has_more),
+            ('messages', MessageSerializer(messages, many=True, context=context).data),
+            ('rooms', RoomSerializer(rooms, many=True, context=context).data),
+            ('reads', [{'room': event.room_id, 'user': event.user_id, 'message': event.message_id}
+                       for event in events if event.kind == SyncEvent.READ]),
+        ]))
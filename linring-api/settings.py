@@ -32,6 +32,7 @@ ALLOWED_HOSTS = ['*']
 # Application definition
 
 INSTALLED_APPS = [
+    'daphne',  # runserver serves the ASGI application, websockets included
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -87,6 +88,14 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'linring-api.wsgi.application'
+ASGI_APPLICATION = 'linring-api.asgi.application'
+
+# in-process layer, enough for a single server process and tests; several processes need channels_redis
+CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+    },
+}
 
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
@@ -98,6 +107,16 @@ DATABASES = {
     }
 }
 
+# shared by every worker process, user-search sessions and their versions must outlive a single process
+# (python manage.py createcachetable)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'cache_table',
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    }
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -236,7 +255,9 @@ FIREBASE_APP = initialize_app()
 # the environment variable contains a path to the custom google service account JSON
 custom_credentials = CustomFirebaseCredentials(
     os.path.join(BASE_DIR, 'linring-a3e66-firebase-adminsdk-vumb7-53e3e56fc8.json'))  # custom url json path
-FIREBASE_MESSAGING_APP = initialize_app(custom_credentials, name='messaging')
+# seconds before a firebase request is abandoned
+PUSH_TIMEOUT = 5
+FIREBASE_MESSAGING_APP = initialize_app(custom_credentials, options={'httpTimeout': PUSH_TIMEOUT}, name='messaging')
 FCM_DJANGO_SETTINGS = {
     # an instance of firebase_admin.App to be used as default for all fcm-django requests
     # default: None (the default Firebase app)
@@ -255,6 +276,39 @@ FCM_DJANGO_SETTINGS = {
 AWS_DEFAULT_ACL = None
 CHAT_UNIQUE_ROOM = False
 
+# user-search ranking backend: 'array' scores in memory with NumPy, 'database' ranks with SQL annotations
+MATCHING_BACKEND = 'array'
+# leave out owners the user already has a chat room with, and tagsets already paired in a room
+MATCHING_EXCLUDE_CHAT_PARTNERS = True
+MATCHING_EXCLUDE_PAIRED_TAGSETS = False
+# seconds a user-search/<id>/page ranking stays cached for its cursor
+RECOMMENDATION_SESSION_TTL = 600
+# seconds a manage.py precompute_matches result is served before falling back to live scoring
+PRECOMPUTED_MATCH_TTL = 3600
+# most changes returned by one /api/chat/sync/ call, the client follows has_more for the rest
+CHAT_SYNC_LIMIT = 500
+# chat pushes go through the PushNotification outbox: PUSH_THREADS deliver them in-process once the
+# message commits (0 leaves everything to manage.py push_worker), failures retry with exponential
+# backoff from PUSH_RETRY_BASE up to PUSH_RETRY_MAX seconds, PUSH_MAX_ATTEMPTS times
+PUSH_THREADS = 4
+PUSH_LEASE = 60
+PUSH_RETRY_BASE = 5
+PUSH_RETRY_MAX = 600
+PUSH_MAX_ATTEMPTS = 8
+# pushes for a room pushed less than this many seconds ago are collapsed into one
+PUSH_COALESCE_WINDOW = 3
+# characters of the message text sent as the push preview
+PUSH_PREVIEW_LENGTH = 100
+# 'firebase' sends through FCM, 'fake' keeps the messages in memory for offline runs and tests
+PUSH_TRANSPORT = 'firebase'
+# the circuit opens when PUSH_BREAKER_FAILURE_RATE of at least PUSH_BREAKER_MINIMUM_CALLS firebase calls in
+# the last PUSH_BREAKER_WINDOW seconds failed; pushes then wait in the outbox and after
+# PUSH_BREAKER_RESET seconds one probe call decides whether it closes again
+PUSH_BREAKER_FAILURE_RATE = 0.5
+PUSH_BREAKER_MINIMUM_CALLS = 10
+PUSH_BREAKER_WINDOW = 60
+PUSH_BREAKER_RESET = 30
+
 # ACCOUNT_LOGOUT_ON_GET = True
 
 # AWS Setting
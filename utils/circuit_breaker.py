@@ -0,0 +1,78 @@
+import threading
+import time
+from collections import deque
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing dependency for a while.
+
+    Closed, it records the outcome of every call over the last ``window`` seconds and opens
+    once at least ``minimum_calls`` were made and ``failure_rate`` of them failed. Open, it
+    refuses calls for ``reset_timeout`` seconds, then goes half-open and lets a single probe
+    through: success closes it again, failure opens it for another ``reset_timeout``.
+
+    The state is per process and shared by the threads of that process.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_rate, minimum_calls, window, reset_timeout, clock=time.monotonic):
+        self.failure_rate = failure_rate
+        self.minimum_calls = minimum_calls
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.state = self.CLOSED
+        self.opened_at = None
+        self.probing = False
+        self.calls = deque()
+
+    def allow(self):
+        """Whether a call may go through now. A True in half-open state makes the caller the probe."""
+        with self.lock:
+            if self.state == self.OPEN and self.clock() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.probing = False
+            if self.state == self.HALF_OPEN:
+                if self.probing:
+                    return False
+                self.probing = True
+                return True
+            return self.state == self.CLOSED
+
+    def retry_after(self):
+        """Seconds until a refused call is worth trying again"""
+        with self.lock:
+            if self.state != self.OPEN:
+                return self.reset_timeout if self.state == self.HALF_OPEN else 0
+            return max(self.reset_timeout - (self.clock() - self.opened_at), 0)
+
+    def record(self, success):
+        with self.lock:
+            now = self.clock()
+            if self.state == self.HALF_OPEN:
+                if success:
+                    self.reset()
+                else:
+                    self.open(now)
+                return
+            if self.state == self.OPEN:
+                return
+            self.calls.append((now, success))
+            while self.calls and self.calls[0][0] <= now - self.window:
+                self.calls.popleft()
+            failures = sum(1 for _, ok in self.calls if not ok)
+            if len(self.calls) >= self.minimum_calls and failures >= self.failure_rate * len(self.calls):
+                self.open(now)
+
+    def open(self, now):
+        self.state = self.OPEN
+        self.opened_at = now
+        self.probing = False
+        self.calls.clear()
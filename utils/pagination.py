@@ -1,6 +1,95 @@
-from rest_framework.pagination import PageNumberPagination
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from datetime import datetime
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
 
 class StandardResultsSetPagination(PageNumberPagination):
     page_size = 5
     page_size_query_param = 'page_size'
-    max_page_size = 50
\ No newline at end of file
+    max_page_size = 50
+
+
+class KeysetPagination(BasePagination):
+    """
+    Pages on (created, id) with opaque ``before``/``after`` cursors, so every page is
+    a single range scan over the index whatever the length of the history.
+
+    Without a cursor the newest page is returned. Each page is in chronological order,
+    ``previous`` points at older items and ``next`` at newer ones.
+    """
+    page_size = 30
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    before_query_param = 'before'
+    after_query_param = 'after'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def is_requested(self, request):
+        params = (self.before_query_param, self.after_query_param, self.page_size_query_param)
+        return any(param in request.query_params for param in params)
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def encode_cursor(self, obj):
+        position = f'{obj.created.isoformat()}|{obj.pk}'
+        return urlsafe_b64encode(position.encode()).decode()
+
+    def decode_cursor(self, request, param):
+        cursor = request.query_params.get(param)
+        if cursor is None:
+            return None
+        try:
+            created, pk = urlsafe_b64decode(cursor.encode()).decode().split('|')
+            return datetime.fromisoformat(created), int(pk)
+        except (TypeError, ValueError, UnicodeDecodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        before = self.decode_cursor(request, self.before_query_param)
+        after = self.decode_cursor(request, self.after_query_param)
+
+        if after is not None:
+            created, pk = after
+            rows = list(queryset.filter(Q(created__gt=created) | Q(created=created, pk__gt=pk))
+                        .order_by('created', 'pk')[:page_size + 1])
+            has_older, has_newer = True, len(rows) > page_size
+            page = rows[:page_size]
+        else:
+            if before is not None:
+                created, pk = before
+                queryset = queryset.filter(Q(created__lt=created) | Q(created=created, pk__lt=pk))
+            rows = list(queryset.order_by('-created', '-pk')[:page_size + 1])
+            has_older, has_newer = len(rows) > page_size, before is not None
+            page = rows[:page_size][::-1]
+
+        self.previous_cursor = self.encode_cursor(page[0]) if page and has_older else None
+        self.next_cursor = self.encode_cursor(page[-1]) if page and has_newer else None
+        return page
+
+    def get_link(self, param, cursor):
+        if cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.before_query_param)
+        url = remove_query_param(url, self.after_query_param)
+        return replace_query_param(url, param, cursor)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_link(self.after_query_param, self.next_cursor)),
+            ('previous', self.get_link(self.before_query_param, self.previous_cursor)),
+            ('results', data),
+        ]))